@@ -3,25 +3,55 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import aeat
+from . import comparison
+from . import export
 from . import invoice
+from . import move
+from . import party
+from . import preview
 from . import tax
 
 
 def register():
     Pool.register(
+        aeat.Configuration,
         aeat.Report,
+        aeat.ReportCashJournal,
         aeat.PartyRecord,
+        aeat.Property,
         aeat.PropertyRecord,
+        aeat.DeriveReportStart,
+        aeat.ConsolidateReportStart,
+        comparison.Comparison,
+        comparison.ComparisonLine,
+        comparison.CompareReportStart,
+        export.ExportReportStart,
         invoice.Record,
+        invoice.RecordSummary,
+        invoice.PartyTotal,
+        invoice.PartyChange,
+        invoice.LimitCrossing,
         invoice.Invoice,
         invoice.Recalculate347RecordStart,
         invoice.Recalculate347RecordEnd,
         invoice.Reasign347RecordStart,
         invoice.Reasign347RecordEnd,
+        move.Move,
+        party.Party,
+        party.PartyIdentifier,
+        party.Address,
+        preview.Preview,
+        preview.PreviewContext,
         tax.TaxTemplate,
         tax.Tax,
+        tax.TaxRule,
         module='aeat_347', type_='model')
     Pool.register(
         invoice.Recalculate347Record,
         invoice.Reasign347Record,
+        party.Recompute347Party,
+        aeat.DeriveReport,
+        aeat.ConsolidateReport,
+        comparison.CompareReport,
+        export.ExportReport,
         module='aeat_347', type_='wizard')
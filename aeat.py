@@ -1,25 +1,74 @@
 # This file is part aeat_347 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-import itertools
 import datetime
+import hashlib
+import itertools
 import unicodedata
 import sys
+from collections import defaultdict
 from decimal import Decimal
+from functools import lru_cache
 from retrofix import aeat347
 from retrofix.record import Record, write as retrofix_write
-from trytond.config import config, parse_uri
-from trytond.model import Workflow, ModelSQL, ModelView, fields
+from stdnum.es import nif as es_nif
+from stdnum.eu import vat as eu_vat
+from sql import Cast, Column, Literal, Null, Union
+from sql.aggregate import Aggregate, Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from trytond import backend
+from trytond.model import (Workflow, ModelSingleton, ModelSQL, ModelView,
+    fields)
 from trytond.pool import Pool
-from trytond.pyson import Bool, Eval, Not
+from trytond.pyson import Bool, Eval, If, Not, PYSONEncoder
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from .tools import check_company, keyset_page
 
-__all__ = ['Report', 'PartyRecord', 'PropertyRecord']
+__all__ = ['Configuration', 'Report', 'ReportCashJournal', 'PartyRecord',
+    'Property', 'PropertyRecord', 'DeriveReportStart', 'DeriveReport',
+    'ConsolidateReportStart', 'ConsolidateReport']
 
 _ZERO = Decimal('0.0')
 
+
+class ArrayAgg(Aggregate):
+    __slots__ = ()
+    _sql = 'ARRAY_AGG'
+
+
+class GroupConcat(Aggregate):
+    __slots__ = ()
+    _sql = 'GROUP_CONCAT'
+
+
+# Record ids are aggregated as an array on PostgreSQL and as a comma
+# separated string on the other backends
+AggregateIds = ArrayAgg if backend.name == 'postgresql' else GroupConcat
+
+
+def numeric_literal(value):
+    '''
+    Return value as a numeric SQL expression to compare it with a sum of
+    amounts. Decimal is adapted to bytes on SQLite so it must be casted.
+    '''
+    return Cast(Literal(value), 'NUMERIC')
+
+
+def line_columns(Model):
+    'Return the names of the columns of the report lines of Model'
+    return sorted(n for n, f in Model._fields.items()
+        if not isinstance(f, (fields.Function, fields.One2Many,
+                fields.Many2Many))
+        and n not in {'id', 'report', 'create_uid', 'create_date',
+            'write_uid', 'write_date'})
+
+
 OPERATION_KEY = [
     (None, 'Leave Empty'),
     ('A', 'A - Good and service adquisitions above limit (1)'),
@@ -34,6 +83,43 @@ OPERATION_KEY = [
     ('G', 'G - Travel Agency Purchases'),
     ]
 
+VAT_ERRORS = [
+    (None, ''),
+    ('missing_party_vat', 'Missing VAT Number'),
+    ('invalid_party_vat', 'Invalid NIF, NIE or CIF'),
+    ('invalid_community_vat', 'Invalid Community VAT Number'),
+    ]
+
+
+def file_record(record_type, values):
+    'Return the record of the file of record_type with values'
+    record = Record(record_type)
+    for name, value in values.items():
+        setattr(record, name, value)
+    return record
+
+
+def render_file(header, parties, properties):
+    '''
+    Return the content of the file of the header, party and property record
+    values
+    '''
+    records = [file_record(aeat347.PRESENTER_HEADER_RECORD, header)]
+    for record_type, lines in [
+            (aeat347.PARTY_RECORD, parties),
+            (aeat347.PROPERTY_RECORD, properties),
+            ]:
+        for values in lines:
+            record = file_record(record_type, values)
+            record.fiscalyear = header['fiscalyear']
+            record.nif = header['nif']
+            records.append(record)
+    data = retrofix_write(records)
+    data = remove_accents(data).upper()
+    if isinstance(data, str):
+        data = data.encode('iso-8859-1')
+    return data
+
 
 def remove_accents(unicode_string):
     str_ = str if sys.version_info < (3, 0) else bytes
@@ -60,6 +146,39 @@ def remove_accents(unicode_string):
     return unicodedata.normalize('NFC', unicode_string_nfd)
 
 
+@lru_cache(maxsize=None)
+def check_vat(party_vat, community_vat, country_code):
+    '''
+    Return the message id of the error found on the identifiers of a party
+    record or None if they are valid.
+    The result only depends on its arguments so it is kept between calls.
+    '''
+    if country_code == 'ES':
+        if not party_vat:
+            return 'missing_party_vat'
+        if not es_nif.is_valid(party_vat):
+            return 'invalid_party_vat'
+    elif community_vat:
+        if country_code and country_code.lower() in eu_vat.MEMBER_STATES:
+            if not eu_vat.is_valid(country_code + community_vat):
+                return 'invalid_community_vat'
+        elif len(community_vat) > 17 or not community_vat.isalnum():
+            return 'invalid_community_vat'
+
+
+class Configuration(ModelSingleton, ModelSQL, ModelView):
+    'AEAT 347 Configuration'
+    __name__ = 'aeat.347.configuration'
+    operation_limit = fields.Numeric('Invoiced Limit (1)', digits=(16, 2),
+        required=True, help='Default limit of the reports. A limit crossing '
+        'is created when the total of a party goes over it on posting an '
+        'invoice.')
+
+    @staticmethod
+    def default_operation_limit():
+        return Decimal('3005.06')
+
+
 class Report(Workflow, ModelSQL, ModelView):
     'AEAT 347 Report'
     __name__ = "aeat.347.report"
@@ -73,6 +192,8 @@ class Report(Workflow, ModelSQL, ModelView):
         states={
             'readonly': Eval('state') == 'done',
             }, depends=['state'])
+    declaration_number = fields.Char('Declaration Number', size=13,
+        readonly=True, help='The number of the declaration on its file')
     representative_vat = fields.Char('L.R. VAT number', size=9,
         help='Legal Representative VAT number.', states={
             'readonly': Eval('state') == 'done',
@@ -100,6 +221,11 @@ class Report(Workflow, ModelSQL, ModelView):
                 'readonly': Eval('state') == 'done',
             }, depends=['state'])
     calculation_date = fields.DateTime('Calculation Date')
+    calculation_mark = fields.BigInteger('Calculation Mark', readonly=True,
+        help='The mark of the party changes seen by the last calculation')
+    archived = fields.Boolean('Archived', readonly=True,
+        help='The records of the fiscal year have been replaced by their '
+        'summaries')
     state = fields.Selection([
             ('draft', 'Draft'),
             ('calculated', 'Calculated'),
@@ -124,6 +250,14 @@ class Report(Workflow, ModelSQL, ModelView):
         'Party Limit (3)', digits=(16, 2), required=True,
         help='The declaration will include parties from which we received '
         'payments, on behalf of third parties, over this limit')
+    cash_journals = fields.Many2Many('aeat.347.report-account.journal',
+        'report', 'journal', 'Cash Journals', domain=[
+            ('type', '=', 'cash'),
+            ], states={
+            'readonly': Eval('state') == 'done',
+            }, depends=['state'],
+        help='Cash received from parties is computed from the posted moves '
+        'of these journals')
     amount = fields.Function(fields.Numeric('Amount', digits=(16, 2)),
         'get_totals')
     cash_amount = fields.Function(fields.Numeric('Cash Amount (Manual)',
@@ -144,11 +278,17 @@ class Report(Workflow, ModelSQL, ModelView):
         'Property Records', states={
             'readonly': Eval('state') == 'done',
             }, depends=['state'])
+    invalid_parties = fields.One2Many('aeat.347.report.party', 'report',
+        'Invalid Party Records', filter=[('vat_error_code', '!=', None)],
+        readonly=True)
     file_ = fields.Binary('File', filename='filename', states={
             'invisible': Eval('state') != 'done',
             })
     filename = fields.Function(fields.Char("File Name"),
         'get_filename')
+    # Fields of the report the calculation of the party records depends on
+    _calculation_fields = {'company', 'fiscalyear', 'operation_limit',
+        'received_cash_limit', 'group_by_vat', 'cash_journals'}
 
     @classmethod
     def __setup__(cls):
@@ -159,7 +299,7 @@ class Report(Workflow, ModelSQL, ModelView):
                             'cancelled']),
                     },
                 'calculate': {
-                    'invisible': ~Eval('state').in_(['draft']),
+                    'invisible': ~Eval('state').in_(['draft', 'calculated']),
                     },
                 'process': {
                     'invisible': ~Eval('state').in_(['calculated']),
@@ -167,9 +307,15 @@ class Report(Workflow, ModelSQL, ModelView):
                 'cancel': {
                     'invisible': Eval('state').in_(['cancelled']),
                     },
+                'archive': {
+                    'invisible': ((Eval('state') != 'done')
+                        | Eval('archived', False)),
+                    'depends': ['state', 'archived'],
+                    },
                 })
         cls._transitions |= set((
                 ('draft', 'calculated'),
+                ('calculated', 'calculated'),
                 ('draft', 'cancelled'),
                 ('calculated', 'draft'),
                 ('calculated', 'done'),
@@ -180,7 +326,8 @@ class Report(Workflow, ModelSQL, ModelView):
 
     @staticmethod
     def default_operation_limit():
-        return Decimal('3005.06')
+        Configuration = Pool().get('aeat.347.configuration')
+        return Configuration(1).operation_limit
 
     @staticmethod
     def default_on_behalf_third_party_limit():
@@ -190,6 +337,11 @@ class Report(Workflow, ModelSQL, ModelView):
     def default_received_cash_limit():
         return Decimal('6000.00')
 
+    @staticmethod
+    def default_cash_journals():
+        Journal = Pool().get('account.journal')
+        return [j.id for j in Journal.search([('type', '=', 'cash')])]
+
     @staticmethod
     def default_type():
         return 'N'
@@ -249,20 +401,40 @@ class Report(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def get_totals(cls, reports, names):
+        pool = Pool()
+        PartyRecord = pool.get('aeat.347.report.party')
+        PropertyRecord = pool.get('aeat.347.report.property')
+        cursor = Transaction().connection.cursor()
+
+        def to_decimal(value):
+            if not isinstance(value, Decimal):
+                return Decimal(str(value or 0))
+            return value
+
         res = {}
         for name in ('party_count', 'property_count'):
             res[name] = dict.fromkeys([x.id for x in reports], 0)
         for name in ('party_amount', 'cash_amount', 'property_amount'):
             res[name] = dict.fromkeys([x.id for x in reports], _ZERO)
-        for report in reports:
-            res['party_amount'][report.id] = Decimal(sum([x.amount for x in
-                    report.parties if x.amount is not None]))
-            res['party_count'][report.id] = len(report.parties)
-            res['cash_amount'][report.id] = Decimal(sum([x.cash_amount for x in
-                    report.parties if x.cash_amount is not None]))
-            res['property_amount'][report.id] = Decimal(sum([x.amount for x in
-                    report.properties if x.amount is not None]))
-            res['property_count'][report.id] = len(report.properties)
+
+        party = PartyRecord.__table__()
+        property_ = PropertyRecord.__table__()
+        for sub_ids in grouped_slice([x.id for x in reports]):
+            cursor.execute(*party.select(party.report, Count(Literal('*')),
+                    Sum(party.amount), Sum(party.cash_amount),
+                    where=reduce_ids(party.report, sub_ids),
+                    group_by=[party.report]))
+            for report, count, amount, cash_amount in cursor.fetchall():
+                res['party_count'][report] = count
+                res['party_amount'][report] = to_decimal(amount)
+                res['cash_amount'][report] = to_decimal(cash_amount)
+            cursor.execute(*property_.select(property_.report,
+                    Count(Literal('*')), Sum(property_.amount),
+                    where=reduce_ids(property_.report, sub_ids),
+                    group_by=[property_.report]))
+            for report, count, amount in cursor.fetchall():
+                res['property_count'][report] = count
+                res['property_amount'][report] = to_decimal(amount)
         for key in list(res.keys()):
             if key not in names:
                 del res[key]
@@ -277,8 +449,24 @@ class Report(Workflow, ModelSQL, ModelView):
             default['parties'] = None
         if 'properties' not in default:
             default['properties'] = None
+        default.setdefault('archived', False)
+        default.setdefault('declaration_number', None)
+        default.setdefault('calculation_date', None)
+        default.setdefault('calculation_mark', None)
         return super(Report, cls).copy(reports, default=default)
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for reports, values in zip(actions, actions):
+            # The next calculation must recompute all the party records
+            if set(values) & cls._calculation_fields:
+                values = dict(values, calculation_date=None,
+                    calculation_mark=None)
+            args.extend((reports, values))
+        super(Report, cls).write(*args)
+
     @classmethod
     def validate(cls, reports):
         for report in reports:
@@ -289,152 +477,744 @@ class Report(Workflow, ModelSQL, ModelView):
             raise UserError(gettext('aeat_347.invalid_currency',
                 report=self.rec_name))
 
+    @classmethod
+    def validate_vat(cls, reports):
+        pool = Pool()
+        PartyRecord = pool.get('aeat.347.report.party')
+
+        transaction = Transaction()
+        for company, company_reports in cls.get_companies_reports(
+                reports).items():
+            with transaction.set_context(company=company):
+                lines = PartyRecord.search([
+                        ('report', 'in', [r.id for r in company_reports]),
+                        ])
+                to_write = defaultdict(list)
+                for line in lines:
+                    error = check_vat(line.party_vat, line.community_vat,
+                        line.country_code)
+                    if error != line.vat_error_code:
+                        to_write[error].append(line)
+                if to_write:
+                    args = []
+                    for error, lines in to_write.items():
+                        args.extend((lines, {'vat_error_code': error}))
+                    with transaction.set_user(0, set_context=True):
+                        PartyRecord.write(*args)
+
+    def check_invalid_parties(self):
+        if self.invalid_parties:
+            raise UserError(gettext('aeat_347.invalid_party_records',
+                    report=self.rec_name,
+                    count=len(self.invalid_parties)))
+
+    @classmethod
+    def delete_party_records(cls, reports):
+        '''
+        Delete the party records of the reports and unlink their 347 records.
+        It is done with SQL unless the delete of party records is extended.
+        '''
+        pool = Pool()
+        PartyRecord = pool.get('aeat.347.report.party')
+        Record = pool.get('aeat.347.record')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        report_ids = [r.id for r in reports]
+        if PartyRecord.delete.__func__ is not ModelSQL.delete.__func__:
+            with transaction.set_user(0):
+                PartyRecord.delete(PartyRecord.search([
+                            ('report', 'in', report_ids),
+                            ]))
+            return
+
+        party = PartyRecord.__table__()
+        record = Record.__table__()
+        for sub_ids in grouped_slice(report_ids):
+            where = reduce_ids(party.report, sub_ids)
+            cursor.execute(*record.update(
+                    columns=[record.party_record],
+                    values=[Null],
+                    where=record.party_record.in_(
+                        party.select(party.id, where=where))))
+            cursor.execute(*party.delete(where=where))
+
+    @classmethod
+    def get_amounts_query(cls, fiscalyear_ids, party_ids=None):
+        '''
+        Return the union of the fiscal year, party, operation key, month,
+        amount and id of the records and summaries of the fiscal years, only
+        of party_ids if given
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        Summary = pool.get('aeat.347.record.summary')
+
+        record = Record.__table__()
+        summary = Summary.__table__()
+        record_where = reduce_ids(record.fiscalyear, fiscalyear_ids)
+        summary_where = reduce_ids(summary.fiscalyear, fiscalyear_ids)
+        if party_ids is not None:
+            record_where &= reduce_ids(record.party, party_ids)
+            summary_where &= reduce_ids(summary.party, party_ids)
+        queries = [record.select(record.fiscalyear, record.party,
+                record.operation_key, record.month, record.amount, record.id,
+                where=record_where)]
+        # Archived fiscal years only have the summaries, which are added as
+        # one row per quarter on its last month
+        for quarter, name in enumerate(['first_quarter_amount',
+                    'second_quarter_amount', 'third_quarter_amount',
+                    'fourth_quarter_amount'], 1):
+            queries.append(summary.select(summary.fiscalyear, summary.party,
+                    summary.operation_key, Literal(quarter * 3).as_('month'),
+                    Column(summary, name).as_('amount'),
+                    Literal(None).as_('id'),
+                    where=summary_where))
+        return Union(*queries, all_=True)
+
     @staticmethod
-    def aggregate_function():
-        uri = parse_uri(config.get('database', 'uri'))
-        if uri.scheme == 'postgresql':
-            return "array_agg(r.id)"
-        return "group_concat(r.id, ',')"
+    def get_amounts_columns(amounts):
+        '''
+        Return the quarter amounts, total and record ids aggregated from the
+        amounts query
+        '''
+        quarters = [Sum(Case(((amounts.month > (q - 1) * 3)
+                        & (amounts.month <= q * 3), amounts.amount),
+                    else_=0))
+            for q in range(1, 5)]
+        return quarters + [Sum(amounts.amount), AggregateIds(amounts.id)]
+
+    def get_records_query(self, party_ids=None):
+        '''
+        Return the query of the quarter amounts, total and record ids by party
+        and operation key of the records and summaries of the fiscal year
+        over the operation limit, only of party_ids if given
+        '''
+        amounts = self.get_amounts_query([self.fiscalyear.id], party_ids)
+        return amounts.select(amounts.party, amounts.operation_key,
+            *self.get_amounts_columns(amounts),
+            group_by=[amounts.party, amounts.operation_key],
+            having=Sum(amounts.amount) > numeric_literal(
+                self.operation_limit))
 
     @classmethod
-    @ModelView.button
-    @Workflow.transition('calculated')
-    def calculate(cls, reports):
+    def get_reports_query(cls, reports):
+        '''
+        Return the query of get_records_query for the fiscal years of all the
+        reports at once, also grouped by fiscal year. It is over the lowest
+        operation limit of the reports of each fiscal year.
+        '''
+        limits = {}
+        for report in reports:
+            fiscalyear = report.fiscalyear.id
+            limits[fiscalyear] = min(report.operation_limit,
+                limits.get(fiscalyear, report.operation_limit))
+        amounts = cls.get_amounts_query(list(limits))
+        limit = Case(*[(amounts.fiscalyear == f, numeric_literal(l))
+                for f, l in limits.items()])
+        return amounts.select(amounts.fiscalyear, amounts.party,
+            amounts.operation_key, *cls.get_amounts_columns(amounts),
+            group_by=[amounts.fiscalyear, amounts.party,
+                amounts.operation_key],
+            having=Sum(amounts.amount) > limit)
+
+    def get_months_query(self, party_ids=None):
+        '''
+        Return the query of the amount, record and invoice counts by party,
+        operation key and month of the records and summaries of the fiscal
+        year, only of party_ids if given
+        '''
         pool = Pool()
-        Operation = pool.get('aeat.347.report.party')
-        Party = pool.get('party.party')
+        Record = pool.get('aeat.347.record')
+        Summary = pool.get('aeat.347.record.summary')
+
+        record = Record.__table__()
+        summary = Summary.__table__()
+        record_where = record.fiscalyear == self.fiscalyear.id
+        summary_where = summary.fiscalyear == self.fiscalyear.id
+        if party_ids is not None:
+            record_where &= reduce_ids(record.party, party_ids)
+            summary_where &= reduce_ids(summary.party, party_ids)
+        queries = [record.select(record.party, record.operation_key,
+                record.month, record.amount,
+                Literal(1).as_('record_count'),
+                Case((record.invoice != Null, 1), else_=0).as_(
+                    'invoice_count'),
+                where=record_where)]
+        for quarter, name in enumerate(['first_quarter_amount',
+                    'second_quarter_amount', 'third_quarter_amount',
+                    'fourth_quarter_amount'], 1):
+            queries.append(summary.select(summary.party,
+                    summary.operation_key, Literal(quarter * 3),
+                    Column(summary, name), Literal(0), Literal(0),
+                    where=summary_where))
+        # The records of a summary are not by month
+        queries.append(summary.select(summary.party, summary.operation_key,
+                Literal(None), Literal(0), summary.record_count,
+                summary.record_count,
+                where=summary_where))
+        months = Union(*queries, all_=True)
+        return months.select(months.party, months.operation_key,
+            months.month, Sum(months.amount), Sum(months.record_count),
+            Sum(months.invoice_count),
+            group_by=[months.party, months.operation_key, months.month])
+
+    def get_cash_amounts(self):
+        '''
+        Return a dictionary with the cash received from each party on the
+        cash journals when it is over the received cash limit
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        cursor = Transaction().connection.cursor()
 
+        if not self.cash_journals:
+            return {}
+
+        move = Move.__table__()
+        line = MoveLine.__table__()
+        period = Period.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
+
+        amount = Sum(line.credit - line.debit)
+        cursor.execute(*line.join(move, condition=line.move == move.id
+                ).join(period, condition=move.period == period.id
+                ).join(account, condition=line.account == account.id
+                ).join(account_type, condition=account.type == account_type.id
+                ).select(line.party, amount,
+                where=(move.journal.in_([j.id for j in self.cash_journals])
+                    & (period.fiscalyear == self.fiscalyear.id)
+                    & (move.company == self.company.id)
+                    & (move.state == 'posted')
+                    & (line.party != Null)
+                    & (account_type.receivable == True)),
+                group_by=[line.party],
+                having=amount > numeric_literal(
+                    self.received_cash_limit)))
+        return dict(cursor.fetchall())
+
+    def get_property_amounts(self):
+        '''
+        Return the quarter amounts of the records and summaries of the
+        fiscal year grouped by party, operation key and property
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        Summary = pool.get('aeat.347.record.summary')
         cursor = Transaction().connection.cursor()
 
-        with Transaction().set_user(0):
-            Operation.delete(Operation.search([
-                ('report', 'in', [r.id for r in reports])]))
+        record = Record.__table__()
+        summary = Summary.__table__()
+        names = ['first_quarter_amount', 'second_quarter_amount',
+            'third_quarter_amount', 'fourth_quarter_amount']
+        quarters = [Case(((record.month > (q - 1) * 3)
+                    & (record.month <= q * 3), record.amount),
+                else_=0).as_(name) for q, name in enumerate(names, 1)]
+        records = record.select(record.party, record.operation_key,
+            record.property, *(quarters + [record.amount]),
+            where=(record.fiscalyear == self.fiscalyear.id)
+            & (record.property != Null))
+        # Archived fiscal years only have the summaries
+        summaries = summary.select(summary.party, summary.operation_key,
+            summary.property, *([Column(summary, n) for n in names]
+                + [summary.amount]),
+            where=(summary.fiscalyear == self.fiscalyear.id)
+            & (summary.property != Null))
+        amounts = Union(records, summaries, all_=True)
+        cursor.execute(*amounts.select(amounts.party, amounts.operation_key,
+                amounts.property,
+                *[Sum(Column(amounts, n)) for n in names + ['amount']],
+                group_by=[amounts.party, amounts.operation_key,
+                    amounts.property]))
+        return cursor.fetchall()
+
+    def get_party_key(self, party, code, operation_key):
+        if self.group_by_vat and code:
+            return '%s-%s' % (code, operation_key)
+        return '%s-%s' % (party, operation_key)
+
+    def get_changed_parties(self):
+        '''
+        Return the party ids changed since the last calculation with the
+        parties that share a party record with them
+        '''
+        pool = Pool()
+        PartyChange = pool.get('aeat.347.party.change')
+
+        party_ids = PartyChange.get_parties(self.company, self.fiscalyear,
+            self.calculation_mark)
+        if self.group_by_vat and party_ids:
+            # The lines of a VAT number sum all the parties with it
+            PartyIdentifier = pool.get('party.identifier')
+            codes = set()
+            for sub_ids in grouped_slice(list(party_ids)):
+                codes.update(i.code for i in PartyIdentifier.search([
+                            ('party', 'in', list(sub_ids)),
+                            ]))
+            for sub_codes in grouped_slice(list(codes)):
+                party_ids.update(i.party.id for i in PartyIdentifier.search([
+                            ('code', 'in', list(sub_codes)),
+                            ]))
+        if party_ids:
+            # The lines may be of a previous VAT number of the parties
+            party_ids |= self.get_line_parties(party_ids)
+        return party_ids
+
+    def get_line_parties(self, party_ids):
+        '''
+        Return the ids of the parties of the records linked to the party
+        records of the report that have records of party_ids
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        PartyRecord = pool.get('aeat.347.report.party')
+        cursor = Transaction().connection.cursor()
+
+        record = Record.__table__()
+        other = Record.__table__()
+        line = PartyRecord.__table__()
+        result = set()
+        for sub_ids in grouped_slice(list(party_ids)):
+            cursor.execute(*other.join(line,
+                    condition=other.party_record == line.id
+                    ).select(other.party,
+                    where=(line.report == self.id)
+                    & line.id.in_(record.select(record.party_record,
+                            where=reduce_ids(record.party, sub_ids)
+                            & (record.fiscalyear == self.fiscalyear.id))),
+                    group_by=[other.party]))
+            result.update(p for p, in cursor.fetchall())
+        return result
+
+    @classmethod
+    def get_parties_values(cls, party_ids):
+        'Return the name, VAT code and location of the parties by id'
+        Party = Pool().get('party.party')
+
+        parties = {}
+        for party in Party.browse(list(set(party_ids))):
+            code = country_code = vat_code_type = None
+            if party.tax_identifier:
+                vat_code_type = party.tax_identifier.type
+                if party.tax_identifier.type == 'eu_vat':
+                    code, country_code = (party.tax_identifier.code[2:],
+                        party.tax_identifier.code[:2])
+                else:
+                    code, country_code = (party.tax_identifier.code,
+                        party.tax_identifier.type[:2].upper())
+
+            address = party.address_get(type='invoice')
+            if not country_code:
+                if address and address.country:
+                    country_code = address.country.code
+            if address and address.zip and country_code == 'ES':
+                province_code = address.zip.strip()[:2]
+            else:
+                province_code = '99'
+
+            parties[party.id] = {
+                'name': party.name[:38],
+                'code': code,
+                'country_code': country_code,
+                'vat_code_type': vat_code_type,
+                'province_code': province_code,
+                }
+        return parties
+
+    def get_party_values(self, party_ids=None, result=None, parties=None):
+        '''
+        Return the values of the party records by key and of the property
+        records of the report, only for party_ids if given.
+        The rows of get_records_query and the values of the parties can be
+        given when they are computed for several reports at once.
+        '''
+        pool = Pool()
+        Property = pool.get('aeat.347.property')
+        cursor = Transaction().connection.cursor()
 
         def is_decimal(value):
             if not isinstance(value, Decimal):
                 return Decimal(value)
             return value
 
-        for report in reports:
-            query = """
-                SELECT
-                    r.party,
-                    operation_key,
-                    sum(case when month <= 3 then amount else 0 end) as first,
-                    sum(case when month > 3 and month <= 6
-                        then amount else 0 end) as second,
-                    sum(case when month > 6 and month <= 9
-                        then amount else 0 end) as third,
-                    sum(case when month > 9 and month <= 12
-                        then amount else 0 end) as fourth,
-                    sum(amount) as total,
-                    %s
-                FROM
-                    aeat_347_record as r
-                WHERE
-                    r.fiscalyear = %s
-                GROUP BY
-                    r.party, r.operation_key
-                HAVING
-                    sum(amount) > %s
-                """ % (cls.aggregate_function(), report.fiscalyear.id,
-                    report.operation_limit)
-            cursor.execute(query)
+        to_create = {}
+        properties_to_create = []
+        if result is None:
+            cursor.execute(*self.get_records_query(party_ids))
             result = cursor.fetchall()
 
-            party_ids = [r[0] for r in result]
-            parties = dict((p, {}) for p in party_ids)
-            for party in Party.browse(party_ids):
-                code = country_code = vat_code_type = None
-                if party.tax_identifier:
-                    vat_code_type = party.tax_identifier.type
-                    if party.tax_identifier.type == 'eu_vat':
-                        code, country_code = (party.tax_identifier.code[2:],
-                            party.tax_identifier.code[:2])
-                    else:
-                        code, country_code = (party.tax_identifier.code,
-                            party.tax_identifier.type[:2].upper())
-
-                address = party.address_get(type='invoice')
-                if not country_code:
-                    if address and address.country:
-                        country_code = address.country.code
-                if address and address.zip and country_code == 'ES':
-                    province_code = address.zip.strip()[:2]
-                else:
-                    province_code = '99'
-
-                parties[party.id] = {
-                    'name': party.name[:38],
-                    'code': code,
+        party_ids = [r[0] for r in result]
+        if parties is None:
+            parties = self.get_parties_values(party_ids)
+
+        for (party, opkey, q1, q2, q3, q4, amount, records) in result:
+            p = parties[party]
+            name = p['name']
+            code = p['code']
+            country_code = p['country_code']
+            vat_code_type = p['vat_code_type']
+            province_code = p['province_code']
+
+            records = (records if isinstance(records, (list))
+                else (records or '').split(','))
+            # Archived records are only on the summaries
+            records = [r for r in records if r]
+
+            key = self.get_party_key(party, code, opkey)
+            if key in to_create:
+                to_create[key]['amount'] += amount
+                to_create[key]['records'] = [('add',
+                    to_create[key]['records'][0][1] + records)]
+            else:
+                to_create[key] = {
+                    'company': self.company.id,
+                    'amount': is_decimal(amount),
+                    'cash_amount': _ZERO,
+                    'party_vat': (country_code == 'ES' and code and
+                        code[:9] or ''),
+                    'party_name': name,
                     'country_code': country_code,
-                    'vat_code_type': vat_code_type,
                     'province_code': province_code,
-                    }
-
-            to_create = {}
-            for (party, opkey, q1, q2, q3, q4, amount, records) in result:
-                p = parties[party]
-                name = p['name']
-                code = p['code']
-                country_code = p['country_code']
-                vat_code_type = p['vat_code_type']
-                province_code = p['province_code']
-
-                records = (records if isinstance(records, (list))
-                    else records.split(','))
-
-                if report.group_by_vat and code:
-                    key = '%s-%s-%s' % (report.id, code, opkey)
-                else:
-                    key = '%s-%s-%s' % (report.id, party, opkey)
-
-                if key in to_create:
-                    to_create[key]['amount'] += amount
-                    to_create[key]['records'] = [('add',
-                        to_create[key]['records'][0][1] + records)]
-                else:
-                    to_create[key] = {
-                        'amount': is_decimal(amount),
-                        'cash_amount': _ZERO,
-                        'party_vat': (country_code == 'ES' and code and
-                            code[:9] or ''),
-                        'party_name': name,
-                        'country_code': country_code,
-                        'province_code': province_code,
-                        'operation_key': opkey,
-                        'report': report.id,
-                        'community_vat': (country_code != 'ES'
-                            and vat_code_type and code or ''),
-                        'records': [('add', records)],
-                    }
-
-                for f in ['first', 'second', 'third', 'fourth']:
-                    qkey = "%s_quarter_amount" % f
-                    if qkey not in to_create[key]:
-                        to_create[key][qkey] = _ZERO
-
-                    qkey = "%s_quarter_property_amount" % f
+                    'operation_key': opkey,
+                    'report': self.id,
+                    'community_vat': (country_code != 'ES'
+                        and vat_code_type and code or ''),
+                    'records': [('add', records)],
+                    'property_amount': _ZERO,
+                    'fiscalyear_code_cash_operation': None,
+                    'calculation_key': key,
+                    'record_count': 0,
+                    'invoice_count': 0,
+                    'monthly_amounts': None,
+                }
+
+            for f in ['first', 'second', 'third', 'fourth']:
+                qkey = "%s_quarter_amount" % f
+                if qkey not in to_create[key]:
                     to_create[key][qkey] = _ZERO
 
-                to_create[key]['first_quarter_amount'] += is_decimal(q1)
-                to_create[key]['second_quarter_amount'] += is_decimal(q2)
-                to_create[key]['third_quarter_amount'] += is_decimal(q3)
-                to_create[key]['fourth_quarter_amount'] += is_decimal(q4)
+                qkey = "%s_quarter_property_amount" % f
+                to_create[key][qkey] = _ZERO
+
+            to_create[key]['first_quarter_amount'] += is_decimal(q1)
+            to_create[key]['second_quarter_amount'] += is_decimal(q2)
+            to_create[key]['third_quarter_amount'] += is_decimal(q3)
+            to_create[key]['fourth_quarter_amount'] += is_decimal(q4)
+
+        months = defaultdict(lambda: defaultdict(Decimal))
+        cursor.execute(*self.get_months_query(party_ids))
+        for (party, opkey, month, amount, record_count,
+                invoice_count) in cursor.fetchall():
+            key = self.get_party_key(party, parties[party]['code'], opkey)
+            if key not in to_create:
+                continue
+            to_create[key]['record_count'] += int(record_count)
+            to_create[key]['invoice_count'] += int(invoice_count)
+            if month is not None:
+                months[key][month] += is_decimal(amount)
+        for key, amounts in months.items():
+            to_create[key]['monthly_amounts'] = '\n'.join(
+                '%02d: %s' % (month, amount.quantize(Decimal('0.01')))
+                for month, amount in sorted(amounts.items()) if amount)
+
+        # Cash received is declared on the deliveries line of the party
+        for party, cash_amount in self.get_cash_amounts().items():
+            if party not in parties:
+                continue
+            key = self.get_party_key(party, parties[party]['code'], 'B')
+            if key not in to_create:
+                continue
+            to_create[key]['cash_amount'] += is_decimal(cash_amount)
+            to_create[key]['fiscalyear_code_cash_operation'] = (
+                self.fiscalyear_code)
+
+        property_amounts = self.get_property_amounts()
+        properties = dict((p.id, p) for p in Property.browse(
+                list(set(r[2] for r in property_amounts))))
+        for (party, opkey, property_, q1, q2, q3, q4,
+                amount) in property_amounts:
+            if party not in parties:
+                continue
+            key = self.get_party_key(party, parties[party]['code'], opkey)
+            if key not in to_create:
+                continue
+            values = to_create[key]
+            values['business_premises_rent'] = True
+            values['first_quarter_property_amount'] += is_decimal(q1)
+            values['second_quarter_property_amount'] += is_decimal(q2)
+            values['third_quarter_property_amount'] += is_decimal(q3)
+            values['fourth_quarter_property_amount'] += is_decimal(q4)
+            values['property_amount'] += is_decimal(amount)
+            # Only the rents received are declared on property records
+            if opkey != 'B':
+                continue
+            property_values = properties[property_].get_property_values()
+            property_values.update({
+                    'company': self.company.id,
+                    'report': self.id,
+                    'property': property_,
+                    'party_vat': values['party_vat'],
+                    'party_name': values['party_name'],
+                    'amount': is_decimal(amount),
+                    })
+            properties_to_create.append(property_values)
+        return to_create, properties_to_create
 
-        with Transaction().set_user(0, set_context=True):
-            Operation.create(to_create.values())
+    @classmethod
+    def get_reports_party_values(cls, reports):
+        '''
+        Return the values of the party and property records of the reports.
+        The records of all the fiscal years are aggregated in one query and
+        the values of the parties shared by the companies are computed once.
+        '''
+        cursor = Transaction().connection.cursor()
 
-        cls.write(reports, {
-            'calculation_date': datetime.datetime.now(),
-            })
+        results = defaultdict(list)
+        cursor.execute(*cls.get_reports_query(reports))
+        for row in cursor.fetchall():
+            results[row[0]].append(row[1:])
+        parties = cls.get_parties_values(
+            [r[0] for rows in results.values() for r in rows])
+
+        to_create = []
+        properties_to_create = []
+        for report in reports:
+            # The query is over the lowest limit of the fiscal year
+            result = [r for r in results[report.fiscalyear.id]
+                if r[-2] > report.operation_limit]
+            with Transaction().set_context(company=report.company.id):
+                lines, properties = report.get_party_values(
+                    [r[0] for r in result], result=result, parties=parties)
+            to_create.extend(lines.values())
+            properties_to_create.extend(properties)
+        return to_create, properties_to_create
+
+    @staticmethod
+    def get_companies_reports(reports):
+        'Return the reports by company id'
+        companies = defaultdict(list)
+        for report in reports:
+            companies[report.company.id].append(report)
+        return companies
+
+    @classmethod
+    def consolidate(cls, companies, year):
+        '''
+        Calculate the reports of the companies for the fiscal years of year,
+        creating the missing ones, and return them.
+        The user must have access to all the companies.
+        '''
+        User = Pool().get('res.user')
+        transaction = Transaction()
+
+        if transaction.user:
+            allowed = set(User(transaction.user).companies)
+            for company in companies:
+                if company not in allowed:
+                    raise UserError(gettext(
+                            'aeat_347.consolidate_company_not_allowed',
+                            company=company.rec_name))
+
+        reports = []
+        # The access to the companies is checked so the reports of all of
+        # them are read and written without the rules of the user
+        with transaction.set_user(0):
+            for company in set(companies):
+                with transaction.set_context(company=company.id):
+                    reports.append(cls.get_consolidate_report(company, year))
+
+            cls.calculate_lines(reports)
+            # The transition is written in the context of each company
+            for company, company_reports in cls.get_companies_reports(
+                    reports).items():
+                with transaction.set_context(company=company):
+                    cls.write([r for r in company_reports
+                            if r.state != 'calculated'], {
+                            'state': 'calculated',
+                            })
+        return sorted(reports, key=lambda r: companies.index(r.company))
+
+    @classmethod
+    def get_consolidate_report(cls, company, year):
+        '''
+        Return the draft or calculated report of company for the fiscal year
+        of year or a new one
+        '''
+        FiscalYear = Pool().get('account.fiscalyear')
+
+        fiscalyear = FiscalYear.find(company.id,
+            date=datetime.date(year, 1, 1), exception=False)
+        if not fiscalyear:
+            raise UserError(gettext(
+                    'aeat_347.missing_consolidate_fiscalyear',
+                    company=company.rec_name, year=year))
+        fiscalyear = FiscalYear(fiscalyear)
+        reports = cls.search([
+                ('company', '=', company.id),
+                ('fiscalyear', '=', fiscalyear.id),
+                ('state', 'in', ['draft', 'calculated']),
+                ], order=[('id', 'DESC')], limit=1)
+        if reports:
+            report, = reports
+            return report
+        report = cls(company=company, fiscalyear=fiscalyear)
+        report.fiscalyear_code = report.on_change_with_fiscalyear_code()
+        report.company_vat = report.on_change_with_company_vat()
+        report.save()
+        return report
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('calculated')
+    def calculate(cls, reports):
+        '''
+        Calculate the party and property records of the reports.
+        Calculated reports only recompute the lines of the parties changed
+        since their last calculation, keeping the values set by hand on the
+        others.
+        '''
+        cls.calculate_lines(reports)
+
+    @classmethod
+    def calculate_lines(cls, reports):
+        '''
+        Compute the party and property records of the reports.
+        The reports can be of several companies, the records of each one are
+        searched and written in the context of its company.
+        '''
+        pool = Pool()
+        Operation = pool.get('aeat.347.report.party')
+        PropertyRecord = pool.get('aeat.347.report.property')
+        Party = pool.get('party.party')
+        PartyChange = pool.get('aeat.347.party.change')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        mark = PartyChange.get_mark()
+        to_create = []
+        properties_to_create = defaultdict(list)
+        to_write = defaultdict(list)
+        to_delete = defaultdict(list)
+        properties_to_delete = defaultdict(list)
+        full = []
+        for report in reports:
+            company = report.company.id
+            with transaction.set_context(company=company):
+                if not report.is_incremental():
+                    full.append(report)
+                    continue
+                party_ids = report.get_changed_parties()
+                if not party_ids:
+                    continue
+                lines, properties = report.get_party_values(list(party_ids))
+                keys = set(l['calculation_key'] for l in lines.values())
+                for party in Party.browse(list(party_ids)):
+                    code = None
+                    if party.tax_identifier:
+                        code = party.tax_identifier.code
+                        if party.tax_identifier.type == 'eu_vat':
+                            code = code[2:]
+                    keys.update(report.get_party_key(party.id, code, k)
+                        for k, _ in OPERATION_KEY if k)
+                names = set()
+                written = []
+                for line in Operation.search([
+                            ('report', '=', report.id),
+                            ['OR',
+                                ('calculation_key', 'in', list(keys)),
+                                # The key changes with the VAT number
+                                ('records.party', 'in', list(party_ids)),
+                                ],
+                            ]):
+                    names.add((line.party_vat, line.party_name))
+                    values = lines.pop(line.calculation_key, None)
+                    if values is None:
+                        to_delete[company].append(line)
+                    else:
+                        to_write[company].extend(([line], values))
+                        written.append(values)
+                to_create.extend(lines.values())
+                names.update((v['party_vat'], v['party_name'])
+                    for v in itertools.chain(written, lines.values()))
+                if names:
+                    # Property records are only related to the party lines
+                    # by their VAT number and name
+                    properties_to_delete[company].extend(
+                        PropertyRecord.search([
+                                ('report', '=', report.id),
+                                ('property', '!=', None),
+                                ['OR'] + [[
+                                        ('party_vat', '=', v),
+                                        ('party_name', '=', n),
+                                        ] for v, n in names],
+                                ]))
+                properties_to_create[company].extend(properties)
+
+        if full:
+            cls.delete_party_records(full)
+            for company, company_reports in cls.get_companies_reports(
+                    full).items():
+                with transaction.set_context(company=company):
+                    properties_to_delete[company].extend(
+                        PropertyRecord.search([
+                                ('report', 'in',
+                                    [r.id for r in company_reports]),
+                                ('property', '!=', None),
+                                ]))
+            lines, properties = cls.get_reports_party_values(full)
+            to_create.extend(lines)
+            for values in properties:
+                properties_to_create[values['company']].append(values)
+
+        with transaction.set_user(0, set_context=True):
+            Operation.bulk_create(to_create)
+        for company in (set(to_write) | set(to_delete)
+                | set(properties_to_delete) | set(properties_to_create)):
+            with transaction.set_context(company=company), \
+                    transaction.set_user(0, set_context=True):
+                Operation.delete(to_delete[company])
+                if to_write[company]:
+                    Operation.write(*to_write[company])
+                PropertyRecord.delete(properties_to_delete[company])
+                PropertyRecord.create(properties_to_create[company])
+
+        cls.validate_vat(reports)
+        for sub_ids in grouped_slice([r.id for r in reports]):
+            cursor.execute(*table.update(
+                    columns=[table.calculation_date, table.calculation_mark],
+                    values=[CurrentTimestamp(), mark],
+                    where=reduce_ids(table.id, sub_ids)))
+        PartyChange.purge_unused(mark)
+
+    def is_incremental(self):
+        '''
+        Return if the calculation of the report can only recompute the
+        changed parties
+        '''
+        pool = Pool()
+        Operation = pool.get('aeat.347.report.party')
+        if self.state != 'calculated' or self.calculation_mark is None:
+            return False
+        # Lines calculated before the key was stored can not be matched
+        return not Operation.search([
+                ('report', '=', self.id),
+                ('calculation_key', '=', None),
+                ], limit=1)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('done')
     def process(cls, reports):
+        cls.validate_vat(reports)
         for report in reports:
-            report.create_file()
+            report.check_invalid_parties()
+        cls.create_files(reports)
 
     @classmethod
     @ModelView.button
@@ -442,6 +1222,115 @@ class Report(Workflow, ModelSQL, ModelView):
     def cancel(cls, reports):
         pass
 
+    @classmethod
+    @ModelView.button
+    def archive(cls, reports):
+        '''
+        Replace the records of the fiscal years of the reports by their
+        summaries, from which the reports can still be calculated
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        PartyChange = pool.get('aeat.347.party.change')
+        done = set()
+        for report in reports:
+            if report.state != 'done' or report.archived:
+                continue
+            key = (report.company, report.fiscalyear)
+            if key not in done:
+                Record.archive(*key)
+                # No record of the fiscal year changes anymore
+                PartyChange.purge(*key)
+                done.add(key)
+        cls.write([r for r in reports if r.state == 'done'], {
+                'archived': True,
+                })
+
+    @classmethod
+    def derive(cls, reports, type_, differences=False):
+        '''
+        Return the declarations of type_ that follow the done reports, with a
+        copy of their party and property records. If differences, they are
+        recalculated and only keep the records changed since the reports,
+        which is only allowed for complementary declarations.
+        '''
+        if differences and type_ != 'C':
+            raise UserError(gettext('aeat_347.derive_differences_type'))
+        derived = []
+        for report in reports:
+            if report.state != 'done':
+                raise UserError(gettext('aeat_347.derive_not_done',
+                        report=report.rec_name))
+            new, = cls.copy([report], default={
+                    'type': type_,
+                    'previous_number': report.declaration_number,
+                    'state': 'calculated',
+                    'calculation_date': report.calculation_date,
+                    'calculation_mark': report.calculation_mark,
+                    'file_': None,
+                    })
+            cls.copy_lines(report, new)
+            derived.append(new)
+        if differences:
+            cls.calculate(derived)
+            for report, new in zip(reports, derived):
+                cls.delete_unchanged_lines(report, new)
+        return derived
+
+    @classmethod
+    def copy_lines(cls, source, target):
+        'Copy the party and property records of source to target with SQL'
+        pool = Pool()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        for name in ['aeat.347.report.party', 'aeat.347.report.property']:
+            Model = pool.get(name)
+            table = Model.__table__()
+            line = Model.__table__()
+            names = line_columns(Model)
+            cursor.execute(*table.insert(
+                    columns=[Column(table, n) for n in names] + [
+                        table.report, table.create_uid, table.create_date],
+                    values=line.select(*[Column(line, n) for n in names] + [
+                            Literal(target.id), Literal(transaction.user),
+                            CurrentTimestamp()],
+                        where=line.report == source.id)))
+
+    @classmethod
+    def delete_unchanged_lines(cls, source, target):
+        '''
+        Delete the party and property records of target equal to one of
+        source
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        cursor = Transaction().connection.cursor()
+        record = Record.__table__()
+
+        for name in ['aeat.347.report.party', 'aeat.347.report.property']:
+            Model = pool.get(name)
+            table = Model.__table__()
+            line = Model.__table__()
+            condition = line.report == source.id
+            for column_name in line_columns(Model):
+                column = Column(table, column_name)
+                other = Column(line, column_name)
+                condition &= ((column == other)
+                    | ((column == Null) & (other == Null)))
+            cursor.execute(*table.join(line, condition=condition).select(
+                    table.id, where=table.report == target.id))
+            ids = [i for i, in cursor.fetchall()]
+            for sub_ids in grouped_slice(ids):
+                sub_ids = list(sub_ids)
+                if name == 'aeat.347.report.party':
+                    cursor.execute(*record.update(
+                            columns=[record.party_record],
+                            values=[Null],
+                            where=reduce_ids(record.party_record, sub_ids)))
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.id, sub_ids)))
+
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
@@ -459,36 +1348,59 @@ class Report(Workflow, ModelSQL, ModelView):
             ], count=True)
         return count + 1
 
+    def get_file_values(self, sequence):
+        '''
+        Return the values of the header, party and property records of the
+        file of the report with the declaration sequence
+        '''
+        header = {
+            'fiscalyear': str(self.fiscalyear_code),
+            'nif': self.company_vat,
+            'presenter_name': self.company.party.name,
+            'support_type': self.support_type,
+            'contact_phone': self.contact_phone,
+            'contact_name': self.contact_name,
+            'declaration_number': int('347{}{:0>6}'.format(
+                    self.fiscalyear_code, sequence)),
+            'previous_declaration_number': self.previous_number,
+            'party_count': self.party_count,
+            'party_amount': self.party_amount,
+            'property_count': self.property_count,
+            'property_amount': self.property_amount or Decimal('0.0'),
+            'representative_nif': self.representative_vat,
+            }
+        parties = [l.get_record_values() for l in self.parties]
+        properties = [l.get_record_values() for l in self.properties]
+        return header, parties, properties
+
     def create_file(self):
-        records = []
-        record = Record(aeat347.PRESENTER_HEADER_RECORD)
-        record.fiscalyear = str(self.fiscalyear_code)
-        record.nif = self.company_vat
-        record.presenter_name = self.company.party.name
-        record.support_type = self.support_type
-        record.contact_phone = self.contact_phone
-        record.contact_name = self.contact_name
-        record.declaration_number = int('347{}{:0>6}'.format(
-            self.fiscalyear_code,
-            self.auto_sequence()))
-        record.previous_declaration_number = self.previous_number
-        record.party_count = len(self.parties)
-        record.party_amount = self.party_amount
-        record.property_count = len(self.properties)
-        record.property_amount = self.property_amount or Decimal('0.0')
-        record.representative_nif = self.representative_vat
-        records.append(record)
-        for line in itertools.chain(self.parties, self.properties):
-            record = line.get_record()
-            record.fiscalyear = str(self.fiscalyear_code)
-            record.nif = self.company_vat
-            records.append(record)
-        data = retrofix_write(records)
-        data = remove_accents(data).upper()
-        if isinstance(data, str):
-            data = data.encode('iso-8859-1')
-        self.file_ = self.__class__.file_.cast(data)
-        self.save()
+        self.create_files([self])
+
+    @classmethod
+    def create_files(cls, reports):
+        '''
+        Create the files of the reports with consecutive declaration numbers.
+        Each report is rendered and stored before reading the lines of the
+        next one so only the values of one file are kept in memory.
+        '''
+        if not reports:
+            return
+        sequence = reports[0].auto_sequence()
+        for i, report in enumerate(reports):
+            header, parties, properties = report.get_file_values(sequence + i)
+            report.declaration_number = str(header['declaration_number'])
+            report.file_ = cls.file_.cast(
+                render_file(header, parties, properties))
+            cls.save([report])
+
+
+class ReportCashJournal(ModelSQL):
+    'AEAT 347 Report - Cash Journal'
+    __name__ = 'aeat.347.report-account.journal'
+    report = fields.Many2One('aeat.347.report', 'AEAT 347 Report',
+        ondelete='CASCADE', select=True, required=True)
+    journal = fields.Many2One('account.journal', 'Journal',
+        ondelete='CASCADE', select=True, required=True)
 
 
 class PartyRecord(ModelSQL, ModelView):
@@ -556,11 +1468,256 @@ class PartyRecord(ModelSQL, ModelView):
         'Quarter Property Amount', digits=(16, 2))
     records = fields.One2Many('aeat.347.record', 'party_record',
         'AEAT 347 Records', readonly=True)
+    record_count = fields.Integer('Record Count', readonly=True)
+    invoice_count = fields.Integer('Invoice Count', readonly=True)
+    monthly_amounts = fields.Text('Monthly Amounts', readonly=True,
+        help='The amount of the records by month. Archived records are on '
+        'the last month of their quarter.')
+    vat_error_code = fields.Selection(VAT_ERRORS, 'VAT Error Code',
+        readonly=True)
+    vat_error = fields.Function(fields.Char('VAT Error'), 'get_vat_error')
+    calculation_key = fields.Char('Calculation Key', readonly=True,
+        select=True)
+    digest = fields.Char('Digest', readonly=True,
+        help='The hash of the values of the record in the declaration')
+    # Fields of the declaration that compose the digest
+    _digest_fields = ['party_vat', 'community_vat', 'representative_vat',
+        'party_name', 'province_code', 'country_code', 'operation_key',
+        'amount', 'insurance', 'business_premises_rent', 'cash_vat_operation',
+        'cash_vat_criteria', 'tax_person_operation', 'related_goods_operation',
+        'cash_amount', 'property_amount', 'fiscalyear_code_cash_operation',
+        'first_quarter_amount', 'first_quarter_property_amount',
+        'second_quarter_amount', 'second_quarter_property_amount',
+        'third_quarter_amount', 'third_quarter_property_amount',
+        'fourth_quarter_amount', 'fourth_quarter_property_amount']
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyRecord, cls).__setup__()
+        cls.__rpc__.update({
+                'get_page': RPC(),
+                })
+        cls._buttons.update({
+                'open_records': {},
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        table = cls.__table_handler__(module_name)
+
+        exist_vat_error = table.column_exist('vat_error')
+        super(PartyRecord, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        table.index_action(['report', 'id'], 'add')
+
+        # Migration from the translated VAT error messages: store their code
+        if exist_vat_error:
+            cursor.execute(*sql_table.select(sql_table.id,
+                    sql_table.party_vat, sql_table.community_vat,
+                    sql_table.country_code,
+                    where=sql_table.vat_error != Null))
+            codes = defaultdict(list)
+            for id_, party_vat, community_vat, country_code in cursor:
+                codes[check_vat(party_vat, community_vat,
+                        country_code)].append(id_)
+            for code, ids in codes.items():
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*sql_table.update(
+                            [sql_table.vat_error_code], [code],
+                            where=reduce_ids(sql_table.id, sub_ids)))
+            table.drop_column('vat_error')
 
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
 
+    @classmethod
+    @ModelView.button_action('aeat_347.act_aeat_347_party_record_records')
+    def open_records(cls, records):
+        pass
+
+    @classmethod
+    def get_page(cls, report, after=None, limit=None, operation_keys=None):
+        '''
+        Return a page of the party records of report of the company in the
+        context, after the id after and of operation_keys if given, as lists
+        of values by field name. Only the records readable by the rules of
+        the user are returned.
+        '''
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+        Report = pool.get('aeat.347.report')
+        ModelAccess.check(cls.__name__, 'read')
+        ModelAccess.check(Report.__name__, 'read')
+        company = Transaction().context.get('company')
+        check_company(company)
+
+        table = cls.__table__()
+        where = ((table.report == report)
+            & (table.company == (company or -1))
+            & table.report.in_(Rule.query_get(Report.__name__))
+            & table.id.in_(Rule.query_get(cls.__name__)))
+        if operation_keys:
+            where &= table.operation_key.in_(operation_keys)
+        columns = [(n, Column(table, n)) for n in ['id', 'party_vat',
+                'community_vat', 'representative_vat', 'party_name',
+                'province_code', 'country_code', 'operation_key', 'amount',
+                'first_quarter_amount', 'second_quarter_amount',
+                'third_quarter_amount', 'fourth_quarter_amount',
+                'property_amount', 'cash_amount', 'insurance',
+                'business_premises_rent', 'cash_vat_operation',
+                'tax_person_operation', 'related_goods_operation',
+                'vat_error_code']]
+        return keyset_page(table, table.id, columns, where, after=after,
+            limit=limit)
+
+    @classmethod
+    def create(cls, vlist):
+        defaults = cls.default_get(cls._digest_fields, with_rec_name=False)
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            values['digest'] = cls.compute_digest(dict(defaults, **values))
+        return super(PartyRecord, cls).create(vlist)
+
+    @classmethod
+    def bulk_create(cls, vlist):
+        '''
+        Create the party records of vlist of the reports calculation with one
+        insert statement per slice and link their 347 records by report and
+        calculation key.
+        It falls back to create when it is extended by other modules.
+        '''
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        record = Record.__table__()
+
+        if cls.create.__func__ is not PartyRecord.create.__func__:
+            companies = defaultdict(list)
+            for values in vlist:
+                companies[values['company']].append(values)
+            for company, company_vlist in companies.items():
+                with transaction.set_context(company=company):
+                    cls.create(company_vlist)
+            return
+        if not vlist:
+            return
+
+        names = line_columns(cls) + ['report']
+        defaults = cls.default_get(names, with_rec_name=False)
+        to_link = {}
+        rows = []
+        for values in vlist:
+            values = dict(defaults, **values)
+            values['digest'] = cls.compute_digest(values)
+            records = [int(i) for _, ids in values.get('records', [])
+                for i in ids]
+            if records:
+                to_link[(values['report'], values['calculation_key'])] = (
+                    records)
+            rows.append([values.get(n) for n in names])
+        lines = {}
+        returning = backend.name == 'postgresql'
+        if not returning:
+            # The lines copied or created by hand may have the same keys
+            cursor.execute(*table.select(Coalesce(Max(table.id), 0)))
+            last_id, = cursor.fetchone()
+        for sub_rows in grouped_slice(rows):
+            cursor.execute(*table.insert(
+                    columns=[Column(table, n) for n in names]
+                    + [table.create_uid, table.create_date],
+                    values=[r + [transaction.user, CurrentTimestamp()]
+                        for r in sub_rows],
+                    returning=([table.id, table.report, table.calculation_key]
+                        if returning else None)))
+            if returning:
+                for id_, report, key in cursor.fetchall():
+                    lines[(report, key)] = id_
+
+        if not returning:
+            report_ids = list(set(r for r, _ in to_link))
+            for sub_ids in grouped_slice(report_ids):
+                cursor.execute(*table.select(table.id, table.report,
+                        table.calculation_key,
+                        where=reduce_ids(table.report, sub_ids)
+                        & (table.id > last_id)))
+                for id_, report, key in cursor.fetchall():
+                    lines[(report, key)] = id_
+        # The records of many lines are linked by slice with one statement
+        links = sorted((i, lines[k]) for k, ids in to_link.items()
+            for i in ids)
+        for sub_links in grouped_slice(links):
+            sub_links = list(sub_links)
+            cursor.execute(*record.update(
+                    columns=[record.party_record],
+                    values=[Case(*[(record.id == i, l)
+                                for i, l in sub_links])],
+                    where=reduce_ids(record.id, [i for i, _ in sub_links])))
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for records, values in zip(actions, actions):
+            if set(values) & set(cls._digest_fields):
+                # Write once the records that end with the same digest
+                digests = defaultdict(list)
+                for record in records:
+                    digests[record.get_digest(values)].append(record)
+                for digest, sub_records in digests.items():
+                    args.extend((sub_records, dict(values, digest=digest)))
+            else:
+                args.extend((records, values))
+        super(PartyRecord, cls).write(*args)
+
+    @classmethod
+    def digest_value(cls, name, value):
+        'Return the value of the field name as it is in the digest'
+        field = cls._fields[name]
+        if isinstance(field, fields.Boolean):
+            return bool(value)
+        elif value is None:
+            return ''
+        elif isinstance(field, fields.Numeric):
+            return Decimal(str(value)).quantize(Decimal('0.01'))
+        return value
+
+    @classmethod
+    def compute_digest(cls, values):
+        'Return the digest of the declaration values'
+        digest = hashlib.sha1()
+        for name in cls._digest_fields:
+            value = cls.digest_value(name, values.get(name))
+            digest.update(('%s\x1f' % value).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_digest(self, values=None):
+        'Return the digest of the record updated with values'
+        record_values = dict((n, getattr(self, n))
+            for n in self._digest_fields)
+        record_values.update(values or {})
+        return self.compute_digest(record_values)
+
+    @classmethod
+    def set_digest(cls, records):
+        'Store the digest of the records'
+        digests = defaultdict(list)
+        for record in records:
+            digest = record.get_digest()
+            if digest != record.digest:
+                digests[digest].append(record)
+        args = []
+        for digest, sub_records in digests.items():
+            args.extend((sub_records, {'digest': digest}))
+        if args:
+            cls.write(*args)
+
     @staticmethod
     def default_amount():
         return Decimal('0.0')
@@ -601,62 +1758,54 @@ class PartyRecord(ModelSQL, ModelView):
     def default_fourth_quarter_property_amount():
         return Decimal('0.0')
 
+    def get_vat_error(self, name):
+        if self.vat_error_code:
+            return gettext('aeat_347.%s' % self.vat_error_code,
+                party=self.party_name)
+
+    def get_record_values(self):
+        'Return the values of the party record of the file'
+        return {
+            'party_nif': self.party_vat,
+            'community_vat': self.community_vat or '',
+            'representative_nif': self.representative_vat or '',
+            'party_name': remove_accents(self.party_name),
+            'province_code': self.province_code,
+            'country_code': ('' if self.country_code == 'ES'
+                else self.country_code),
+            'operation_key': self.operation_key,
+            'amount': self.amount,
+            'insurance': self.insurance,
+            'business_premises_rent': self.business_premises_rent,
+            'cash_amount': self.cash_amount or _ZERO,
+            'vat_liable_property_amount': (self.property_amount
+                or Decimal('0.0')),
+            'fiscalyear_cash_operation': str(
+                self.fiscalyear_code_cash_operation or ''),
+            'first_quarter_amount': self.first_quarter_amount,
+            'first_quarter_property_amount': (
+                self.first_quarter_property_amount),
+            'second_quarter_amount': self.second_quarter_amount,
+            'second_quarter_property_amount': (
+                self.second_quarter_property_amount),
+            'third_quarter_amount': self.third_quarter_amount,
+            'third_quarter_property_amount': (
+                self.third_quarter_property_amount),
+            'fourth_quarter_amount': self.fourth_quarter_amount,
+            'fourth_quarter_property_amount': (
+                self.fourth_quarter_property_amount),
+            'cash_vat_operation': self.cash_vat_operation,
+            'cash_vat_criteria': (self.cash_vat_criteria or Decimal('0.0')
+                if self.cash_vat_operation else Decimal('0.0')),
+            'tax_person_operation': self.tax_person_operation,
+            'related_goods_operation': self.related_goods_operation,
+            }
 
     def get_record(self):
-        record = Record(aeat347.PARTY_RECORD)
-        record.party_nif = self.party_vat
-        record.community_vat = self.community_vat or ''
-        record.representative_nif = self.representative_vat or ''
-        record.party_name = remove_accents(self.party_name)
-        record.province_code = self.province_code
-        if self.country_code == 'ES':
-            record.country_code = ''
-        else:
-            record.country_code = self.country_code
-        record.operation_key = self.operation_key
-        record.amount = self.amount
-        record.insurance = self.insurance
-        record.business_premises_rent = self.business_premises_rent
-        record.cash_amount = self.cash_amount or _ZERO
-        record.vat_liable_property_amount = self.property_amount \
-            or Decimal('0.0')
-        record.fiscalyear_cash_operation = str(
-            self.fiscalyear_code_cash_operation or '')
-        record.first_quarter_amount = self.first_quarter_amount
-        record.first_quarter_property_amount = (
-            self.first_quarter_property_amount)
-        record.second_quarter_amount = self.second_quarter_amount
-        record.second_quarter_property_amount = (
-            self.second_quarter_property_amount)
-        record.third_quarter_amount = self.third_quarter_amount
-        record.third_quarter_property_amount = (
-            self.third_quarter_property_amount)
-        record.fourth_quarter_amount = self.fourth_quarter_amount
-        record.fourth_quarter_property_amount = (
-            self.fourth_quarter_property_amount)
-        record.cash_vat_operation = self.cash_vat_operation
-        record.cash_vat_criteria = (self.cash_vat_criteria or Decimal('0.0')
-            if self.cash_vat_operation else Decimal('0.0'))
-        record.tax_person_operation = self.tax_person_operation
-        record.related_goods_operation = self.related_goods_operation
-        return record
-
-
-class PropertyRecord(ModelSQL, ModelView):
-    """
-    AEAT 347 Property Record
-    """
-    __name__ = 'aeat.347.report.property'
-    _rec_name = "cadaster_number"
+        return file_record(aeat347.PARTY_RECORD, self.get_record_values())
 
-    company = fields.Many2One('company.company', 'Company', required=True)
-    report = fields.Many2One('aeat.347.report', 'AEAT 347 Report',
-        ondelete='CASCADE', select=1)
-    party_vat = fields.Char('VAT number', size=9)
-    representative_vat = fields.Char('L.R. VAT number', size=9,
-        help='Legal Representative VAT number')
-    party_name = fields.Char('Party Name', size=40)
-    amount = fields.Numeric('Amount', digits=(16, 2))
+
+class PropertyMixin(object):
     situation = fields.Selection([
             ('1', '1 - Spain but Basque Country and Navarra'),
             ('2', '2 - Basque Country and Navarra'),
@@ -691,32 +1840,176 @@ class PropertyRecord(ModelSQL, ModelView):
     province_code = fields.Char('Province Code', size=2)
     zip = fields.Char('Zip', size=5)
 
+    _property_fields = ('situation', 'cadaster_number', 'road_type', 'street',
+        'number_type', 'number', 'number_qualifier', 'block', 'doorway',
+        'stair', 'floor', 'door', 'complement', 'city', 'municipality',
+        'municipality_code', 'province_code', 'zip')
+
+    def get_property_values(self):
+        return dict((f, getattr(self, f)) for f in self._property_fields)
+
+
+class Property(PropertyMixin, ModelSQL, ModelView):
+    """
+    AEAT 347 Property
+    """
+    __name__ = 'aeat.347.property'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    name = fields.Char('Name', required=True)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class PropertyRecord(PropertyMixin, ModelSQL, ModelView):
+    """
+    AEAT 347 Property Record
+    """
+    __name__ = 'aeat.347.report.property'
+    _rec_name = "cadaster_number"
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    report = fields.Many2One('aeat.347.report', 'AEAT 347 Report',
+        ondelete='CASCADE', select=1)
+    party_vat = fields.Char('VAT number', size=9)
+    representative_vat = fields.Char('L.R. VAT number', size=9,
+        help='Legal Representative VAT number')
+    party_name = fields.Char('Party Name', size=40)
+    amount = fields.Numeric('Amount', digits=(16, 2))
+    property = fields.Many2One('aeat.347.property', 'Property',
+        readonly=True, help='The property the record is calculated from. '
+        'Records without property are entered manually.')
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
 
+    def get_record_values(self):
+        'Return the values of the property record of the file'
+        values = {
+            'party_nif': self.party_vat,
+            'representative_nif': self.representative_vat,
+            'party_name': self.party_name,
+            'amount': self.amount,
+            }
+        for name in ['situation', 'cadaster_number', 'road_type', 'street',
+                'number_type', 'number', 'number_qualifier', 'block',
+                'doorway', 'stair', 'floor', 'door', 'complement', 'city',
+                'municipality', 'municipality_code', 'province_code', 'zip']:
+            values[name] = getattr(self, name)
+        return values
+
     def get_record(self):
-        record = Record(aeat347.PROPERTY_RECORD)
-        record.party_nif = self.party_vat
-        record.representative_nif = self.representative_vat
-        record.party_name = self.party_name
-        record.amount = self.amount
-        record.situation = self.situation
-        record.cadaster_number = self.cadaster_number
-        record.road_type = self.road_type
-        record.street = self.street
-        record.number_type = self.number_type
-        record.number = self.number
-        record.number_qualifier = self.number_qualifier
-        record.block = self.block
-        record.doorway = self.doorway
-        record.stair = self.stair
-        record.floor = self.floor
-        record.door = self.door
-        record.complement = self.complement
-        record.city = self.city
-        record.municipality = self.municipality
-        record.municipality_code = self.municipality_code
-        record.province_code = self.province_code
-        record.zip = self.zip
-        return record
+        return file_record(aeat347.PROPERTY_RECORD, self.get_record_values())
+
+
+class DeriveReportStart(ModelView):
+    """
+    Derive AEAT 347 Report Start
+    """
+    __name__ = 'aeat.347.report.derive.start'
+
+    type = fields.Selection([
+            ('C', 'Complementary'),
+            ('S', 'Substitutive'),
+            ], 'Statement Type', required=True)
+    differences = fields.Boolean('Only Differences',
+        states={
+            'invisible': Eval('type') != 'C',
+            },
+        domain=[
+            If(Eval('type') != 'C', ('differences', '=', False), ()),
+            ],
+        depends=['type'],
+        help='Recalculate the new declarations and only keep the records '
+        'that changed since the declarations they follow')
+
+    @staticmethod
+    def default_type():
+        return 'C'
+
+    @staticmethod
+    def default_differences():
+        return True
+
+    @fields.depends('type')
+    def on_change_type(self):
+        self.differences = self.type == 'C'
+
+
+class DeriveReport(Wizard):
+    """
+    Derive AEAT 347 Report
+    """
+    __name__ = 'aeat.347.report.derive'
+    start = StateView('aeat.347.report.derive.start',
+        'aeat_347.aeat_347_report_derive_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Derive', 'derive', 'tryton-ok', default=True),
+            ])
+    derive = StateAction('aeat_347.act_aeat_347_report')
+
+    def do_derive(self, action):
+        Report = Pool().get('aeat.347.report')
+        reports = Report.browse(Transaction().context['active_ids'])
+        derived = Report.derive(reports, self.start.type,
+            differences=self.start.differences)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [r.id for r in derived]),
+                ])
+        return action, {}
+
+
+class ConsolidateReportStart(ModelView):
+    """
+    Consolidate AEAT 347 Reports Start
+    """
+    __name__ = 'aeat.347.report.consolidate.start'
+
+    companies = fields.Many2Many('company.company', None, None, 'Companies',
+        required=True, domain=[
+            ('id', 'in', Eval('allowed_companies', [])),
+            ], depends=['allowed_companies'])
+    allowed_companies = fields.Many2Many('company.company', None, None,
+        'Allowed Companies', readonly=True)
+    year = fields.Integer('Year', required=True,
+        help='The reports are calculated for the fiscal years of the '
+        'companies that start on this year')
+
+    @staticmethod
+    def default_companies():
+        company = Transaction().context.get('company')
+        return [company] if company else []
+
+    @staticmethod
+    def default_allowed_companies():
+        User = Pool().get('res.user')
+        return [c.id for c in User(Transaction().user).companies]
+
+    @staticmethod
+    def default_year():
+        Date = Pool().get('ir.date')
+        return Date.today().year - 1
+
+
+class ConsolidateReport(Wizard):
+    """
+    Consolidate AEAT 347 Reports
+    """
+    __name__ = 'aeat.347.report.consolidate'
+    start = StateView('aeat.347.report.consolidate.start',
+        'aeat_347.aeat_347_report_consolidate_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Calculate', 'consolidate', 'tryton-ok', default=True),
+            ])
+    consolidate = StateAction('aeat_347.act_aeat_347_report')
+
+    def do_consolidate(self, action):
+        Report = Pool().get('aeat.347.report')
+        reports = Report.consolidate(self.start.companies, self.start.year)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [r.id for r in reports]),
+                ])
+        return action, {}
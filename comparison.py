@@ -0,0 +1,302 @@
+# This file is part aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import itertools
+from sql import Column, Literal, Null, Union, Window
+from sql.aggregate import Count
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, RowNumber
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval, PYSONEncoder
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateAction, Button
+from .aeat import OPERATION_KEY
+
+__all__ = ['Comparison', 'ComparisonLine', 'CompareReportStart',
+    'CompareReport']
+
+CHANGES = [
+    ('added', 'Added'),
+    ('removed', 'Removed'),
+    ('changed', 'Changed'),
+    ]
+
+
+class Comparison(ModelSQL, ModelView):
+    """
+    AEAT 347 Report Comparison
+
+    The party records added, removed or changed on a report from another
+    report. Records are matched by calculation key or by VAT number and
+    operation key.
+    """
+    __name__ = 'aeat.347.report.comparison'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    report = fields.Many2One('aeat.347.report', 'AEAT 347 Report',
+        required=True, readonly=True, ondelete='CASCADE', select=True)
+    other_report = fields.Many2One('aeat.347.report', 'Compared Report',
+        required=True, readonly=True, ondelete='CASCADE')
+    lines = fields.One2Many('aeat.347.report.comparison.line', 'comparison',
+        'Lines', readonly=True)
+    added_count = fields.Function(fields.Integer('Added'), 'get_counts')
+    removed_count = fields.Function(fields.Integer('Removed'), 'get_counts')
+    changed_count = fields.Function(fields.Integer('Changed'), 'get_counts')
+
+    @classmethod
+    def __setup__(cls):
+        super(Comparison, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def get_counts(cls, comparisons, names):
+        pool = Pool()
+        Line = pool.get('aeat.347.report.comparison.line')
+        cursor = Transaction().connection.cursor()
+        line = Line.__table__()
+
+        result = {}
+        for name in names:
+            result[name] = dict((c.id, 0) for c in comparisons)
+        for sub_ids in grouped_slice([c.id for c in comparisons]):
+            cursor.execute(*line.select(line.comparison, line.change,
+                    Count(line.id),
+                    where=reduce_ids(line.comparison, sub_ids),
+                    group_by=[line.comparison, line.change]))
+            for comparison, change, count in cursor.fetchall():
+                name = '%s_count' % change
+                if name in result:
+                    result[name][comparison] = count
+        return result
+
+    @classmethod
+    def compare(cls, report, other_report):
+        'Return the comparison of report with other_report'
+        pool = Pool()
+        PartyRecord = pool.get('aeat.347.report.party')
+        Line = pool.get('aeat.347.report.comparison.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # Records of previous versions have no digest
+        with transaction.set_user(0, set_context=True):
+            PartyRecord.set_digest(PartyRecord.search([
+                        ('report', 'in', [report.id, other_report.id]),
+                        ('digest', '=', None),
+                        ]))
+            comparison, = cls.create([{
+                        'company': report.company.id,
+                        'report': report.id,
+                        'other_report': other_report.id,
+                        }])
+
+        table = Line.__table__()
+        line = PartyRecord.__table__()
+        other_line = PartyRecord.__table__()
+        pairs = cls.match_lines(report, other_report)
+        query = pairs.join(line, 'LEFT',
+            condition=line.id == pairs.line
+            ).join(other_line, 'LEFT',
+            condition=other_line.id == pairs.other_line)
+        added = pairs.other_line == Null
+        removed = pairs.line == Null
+        both = ~added & ~removed
+        names = ['party_vat', 'community_vat', 'party_name', 'operation_key']
+        cursor.execute(*table.insert(
+                columns=[table.comparison, table.change, table.line,
+                    table.other_line]
+                + [Column(table, n) for n in names]
+                + [table.amount, table.other_amount, table.amount_difference,
+                    table.create_uid, table.create_date],
+                values=query.select(Literal(comparison.id),
+                    Case((added, 'added'), (removed, 'removed'),
+                        else_='changed'),
+                    pairs.line, pairs.other_line,
+                    *([Case((removed, Column(other_line, n)),
+                                else_=Column(line, n)) for n in names]
+                        + [line.amount, other_line.amount,
+                            Case((both, Coalesce(line.amount, 0)
+                                    - Coalesce(other_line.amount, 0))),
+                            Literal(0), CurrentTimestamp()]),
+                    where=~both | (line.digest != other_line.digest))))
+
+        # Only the changed records are read to compute the differences
+        cursor.execute(*table.select(table.id, table.line, table.other_line,
+                where=(table.comparison == comparison.id)
+                & (table.change == 'changed')))
+        for sub_rows in grouped_slice(cursor.fetchall()):
+            sub_rows = list(sub_rows)
+            records = PartyRecord.browse(list(itertools.chain.from_iterable(
+                        r[1:] for r in sub_rows)))
+            records = dict((r.id, r) for r in records)
+            args = []
+            for line_id, record_id, other_id in sub_rows:
+                args.extend(([Line(line_id)], Line.get_differences(
+                            records[record_id], records[other_id])))
+            with transaction.set_user(0, set_context=True):
+                Line.write(*args)
+        return comparison
+
+    @staticmethod
+    def match_lines(report, other_report):
+        '''
+        Return the query of the line and other_line ids of the party records
+        of two reports that are the same, with NULL when it is only on one of
+        them.
+        They are matched by calculation key when it is unique on both reports
+        and then by VAT numbers and operation key, or party name without VAT
+        number. The records with the same of these keys are ranked by name to
+        be matched in order.
+        '''
+        PartyRecord = Pool().get('aeat.347.report.party')
+
+        def unique_keys(report):
+            line = PartyRecord.__table__()
+            return line.select(line.calculation_key,
+                where=(line.report == report.id)
+                & (line.calculation_key != Null),
+                group_by=[line.calculation_key],
+                having=Count(Literal('*')) == 1)
+
+        def keyed(line):
+            return (line.calculation_key.in_(unique_keys(report))
+                & line.calculation_key.in_(unique_keys(other_report)))
+
+        def ranked(report):
+            line = PartyRecord.__table__()
+            party_vat = Coalesce(line.party_vat, '')
+            community_vat = Coalesce(line.community_vat, '')
+            party_name = Case(((party_vat == '') & (community_vat == ''),
+                    Coalesce(line.party_name, '')), else_='')
+            operation_key = Coalesce(line.operation_key, '')
+            return line.select(line.id,
+                party_vat.as_('party_vat'),
+                community_vat.as_('community_vat'),
+                party_name.as_('party_name'),
+                operation_key.as_('operation_key'),
+                RowNumber(window=Window(
+                        [party_vat, community_vat, party_name, operation_key],
+                        order_by=[Coalesce(line.party_name, '').asc,
+                            line.id.asc])).as_('rank'),
+                where=(line.report == report.id) & ~keyed(line))
+
+        line = PartyRecord.__table__()
+        other_line = PartyRecord.__table__()
+        by_key = line.join(other_line,
+            condition=(line.calculation_key == other_line.calculation_key)
+            ).select(line.id.as_('line'), other_line.id.as_('other_line'),
+            where=(line.report == report.id)
+            & (other_line.report == other_report.id) & keyed(line))
+
+        rows, other_rows = ranked(report), ranked(other_report)
+        condition = rows.rank == other_rows.rank
+        for name in ['party_vat', 'community_vat', 'party_name',
+                'operation_key']:
+            condition &= Column(rows, name) == Column(other_rows, name)
+        by_rank = rows.join(other_rows, 'FULL', condition=condition).select(
+            rows.id.as_('line'), other_rows.id.as_('other_line'))
+        return Union(by_key, by_rank, all_=True)
+
+
+class ComparisonLine(ModelSQL, ModelView):
+    """
+    AEAT 347 Report Comparison Line
+    """
+    __name__ = 'aeat.347.report.comparison.line'
+
+    comparison = fields.Many2One('aeat.347.report.comparison', 'Comparison',
+        required=True, readonly=True, ondelete='CASCADE', select=True)
+    change = fields.Selection(CHANGES, 'Change', required=True, readonly=True)
+    party_vat = fields.Char('VAT', readonly=True)
+    community_vat = fields.Char('Community VAT number', readonly=True)
+    party_name = fields.Char('Party Name', readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation Key',
+        readonly=True)
+    line = fields.Many2One('aeat.347.report.party', 'Party Record',
+        readonly=True, ondelete='SET NULL')
+    other_line = fields.Many2One('aeat.347.report.party',
+        'Compared Party Record', readonly=True, ondelete='SET NULL')
+    amount = fields.Numeric('Operations Amount', digits=(16, 2),
+        readonly=True)
+    other_amount = fields.Numeric('Compared Operations Amount',
+        digits=(16, 2), readonly=True)
+    amount_difference = fields.Numeric('Amount Difference', digits=(16, 2),
+        readonly=True)
+    changed_fields = fields.Char('Changed Fields', readonly=True,
+        help='The names of the changed fields, to filter the lines')
+    differences = fields.Text('Differences', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ComparisonLine, cls).__setup__()
+        cls._order.insert(0, ('change', 'ASC'))
+        cls._order.insert(1, ('party_name', 'ASC'))
+
+    @classmethod
+    def get_differences(cls, line, other_line):
+        'Return the values of the differences of line from other_line'
+        PartyRecord = Pool().get('aeat.347.report.party')
+        names = []
+        differences = []
+        for name in PartyRecord._digest_fields:
+            value = PartyRecord.digest_value(name, getattr(line, name))
+            other_value = PartyRecord.digest_value(name,
+                getattr(other_line, name))
+            if value != other_value:
+                names.append(name)
+                differences.append('%s: %s -> %s' % (
+                        PartyRecord._fields[name].string, other_value, value))
+        return {
+            'changed_fields': ','.join(names),
+            'differences': '\n'.join(differences),
+            }
+
+
+class CompareReportStart(ModelView):
+    """
+    Compare AEAT 347 Report Start
+    """
+    __name__ = 'aeat.347.report.compare.start'
+
+    report = fields.Many2One('aeat.347.report', 'AEAT 347 Report',
+        readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    other_report = fields.Many2One('aeat.347.report', 'Compared Report',
+        required=True, domain=[
+            ('company', '=', Eval('company', -1)),
+            ('id', '!=', Eval('report', -1)),
+            ], depends=['company', 'report'],
+        help='The report from which the changes are shown')
+
+
+class CompareReport(Wizard):
+    """
+    Compare AEAT 347 Report
+    """
+    __name__ = 'aeat.347.report.compare'
+    start = StateView('aeat.347.report.compare.start',
+        'aeat_347.aeat_347_report_compare_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Compare', 'compare', 'tryton-ok', default=True),
+            ])
+    compare = StateAction('aeat_347.act_aeat_347_report_comparison')
+
+    def default_start(self, fields):
+        Report = Pool().get('aeat.347.report')
+        report = Report(Transaction().context['active_id'])
+        return {
+            'report': report.id,
+            'company': report.company.id,
+            }
+
+    def do_compare(self, action):
+        Comparison = Pool().get('aeat.347.report.comparison')
+        comparison = Comparison.compare(self.start.report,
+            self.start.other_report)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', '=', comparison.id),
+                ])
+        return action, {}
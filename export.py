@@ -0,0 +1,216 @@
+# This file is part aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import csv
+import io
+import mmap
+import tempfile
+from sql import Literal
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from trytond import backend
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.i18n import gettext
+from trytond.exceptions import UserError
+from .tools import check_company
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+__all__ = ['ExportReportStart', 'ExportReport']
+
+PARTY_COLUMNS = ['party_vat', 'community_vat', 'representative_vat',
+    'party_name', 'province_code', 'country_code', 'operation_key', 'amount',
+    'first_quarter_amount', 'second_quarter_amount', 'third_quarter_amount',
+    'fourth_quarter_amount', 'property_amount',
+    'first_quarter_property_amount', 'second_quarter_property_amount',
+    'third_quarter_property_amount', 'fourth_quarter_property_amount',
+    'cash_amount', 'fiscalyear_code_cash_operation', 'insurance',
+    'business_premises_rent', 'cash_vat_operation', 'cash_vat_criteria',
+    'tax_person_operation', 'related_goods_operation', 'vat_error_code']
+PROPERTY_COLUMNS = ['party_vat', 'representative_vat', 'party_name',
+    'amount', 'situation', 'cadaster_number', 'road_type', 'street',
+    'number_type', 'number', 'number_qualifier', 'block', 'doorway', 'stair',
+    'floor', 'door', 'complement', 'city', 'municipality',
+    'municipality_code', 'province_code', 'zip']
+
+
+class ExportReportStart(ModelView):
+    """
+    Export AEAT 347 Report Start
+    """
+    __name__ = 'aeat.347.report.export.start'
+
+    format = fields.Selection([
+            ('csv', 'CSV'),
+            ('xlsx', 'Excel (XLSX)'),
+            ], 'Format', required=True,
+        help='CSV creates one attachment for the party records and another '
+        'for the property records')
+
+    @staticmethod
+    def default_format():
+        return 'csv'
+
+
+class ExportReport(Wizard):
+    """
+    Export AEAT 347 Report
+
+    Write the party and property records of the reports to attachments.
+    Rows are fetched with a server-side cursor on PostgreSQL and written as
+    they come to a temporary file, so the records are never loaded all at
+    once. Only the records readable by the rules of the user are exported.
+    """
+    __name__ = 'aeat.347.report.export'
+    start = StateView('aeat.347.report.export.start',
+        'aeat_347.aeat_347_report_export_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateTransition()
+
+    def transition_export(self):
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+        PropertyRecord = pool.get('aeat.347.report.property')
+
+        if self.start.format == 'xlsx' and openpyxl is None:
+            raise UserError(gettext('aeat_347.missing_openpyxl'))
+        for Model in [Report, PartyRecord, PropertyRecord]:
+            ModelAccess.check(Model.__name__, 'read')
+        reports = Report.browse(Transaction().context['active_ids'])
+        for report in reports:
+            check_company(report.company.id)
+        for report in reports:
+            name = 'aeat347-%s-%s' % (report.fiscalyear_code, report.id)
+            if self.start.format == 'xlsx':
+                self.attach(report, '%s.xlsx' % name,
+                    self.write_xlsx, report)
+            else:
+                self.attach(report, '%s-parties.csv' % name,
+                    self.write_csv, self.party_rows(report))
+                self.attach(report, '%s-properties.csv' % name,
+                    self.write_csv, self.property_rows(report))
+        return 'end'
+
+    @staticmethod
+    def attach(report, name, write, *args):
+        '''
+        Attach to report the file name written by write with args into a
+        temporary file. The attachment is created from a map of the file so
+        its content is not copied into memory.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        with tempfile.TemporaryFile() as file_:
+            write(file_, *args)
+            file_.flush()
+            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                Attachment.create([{
+                            'name': name,
+                            'resource': str(report),
+                            'type': 'data',
+                            'data': data,
+                            }])
+
+    @staticmethod
+    def fetch(query, size=1000):
+        'Yield the rows of query fetched by chunks of size'
+        transaction = Transaction()
+        if backend.name == 'postgresql':
+            # A named cursor keeps the result on the server
+            cursor = transaction.connection.cursor('aeat_347_export')
+        else:
+            cursor = transaction.connection.cursor()
+        try:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def readable(Model, table, report):
+        '''
+        Return the condition of the records of table of report readable by
+        the rules of the user
+        '''
+        pool = Pool()
+        Rule = pool.get('ir.rule')
+        Report = pool.get('aeat.347.report')
+        return ((table.report == report.id)
+            & (table.company == report.company.id)
+            & table.report.in_(Rule.query_get(Report.__name__))
+            & table.id.in_(Rule.query_get(Model.__name__)))
+
+    def party_rows(self, report):
+        'Yield the header and the rows of the party records of report'
+        pool = Pool()
+        PartyRecord = pool.get('aeat.347.report.party')
+        Record = pool.get('aeat.347.record')
+        line = PartyRecord.__table__()
+        record = Record.__table__()
+
+        where = self.readable(PartyRecord, line, report)
+        counts = record.select(record.party_record,
+            Count(Literal('*')).as_('record_count'),
+            Count(record.invoice, distinct=True).as_('invoice_count'),
+            where=record.party_record.in_(line.select(line.id, where=where)),
+            group_by=[record.party_record])
+        query = line.join(counts, 'LEFT',
+            condition=counts.party_record == line.id
+            ).select(*[getattr(line, n) for n in PARTY_COLUMNS] + [
+                    Coalesce(counts.record_count, 0),
+                    Coalesce(counts.invoice_count, 0)],
+            where=where,
+            order_by=[line.id])
+        yield [PartyRecord._fields[n].string for n in PARTY_COLUMNS] + [
+            'Records', 'Invoices']
+        for row in self.fetch(query):
+            yield row
+
+    def property_rows(self, report):
+        'Yield the header and the rows of the property records of report'
+        PropertyRecord = Pool().get('aeat.347.report.property')
+        table = PropertyRecord.__table__()
+
+        query = table.select(*[getattr(table, n) for n in PROPERTY_COLUMNS],
+            where=self.readable(PropertyRecord, table, report),
+            order_by=[table.id])
+        yield [PropertyRecord._fields[n].string for n in PROPERTY_COLUMNS]
+        for row in self.fetch(query):
+            yield row
+
+    @staticmethod
+    def write_csv(file_, rows):
+        'Write rows to file_ as CSV'
+        text = io.TextIOWrapper(file_, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        for row in rows:
+            writer.writerow(['' if v is None else v for v in row])
+        text.flush()
+        text.detach()
+
+    def write_xlsx(self, file_, report):
+        'Write the party and property records of report to file_ as XLSX'
+        # The write only mode of openpyxl does not keep the rows in memory
+        workbook = openpyxl.Workbook(write_only=True)
+        for title, rows in [
+                ('Parties', self.party_rows(report)),
+                ('Properties', self.property_rows(report)),
+                ]:
+            sheet = workbook.create_sheet(title)
+            for row in rows:
+                sheet.append(list(row))
+        workbook.save(file_)
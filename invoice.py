@@ -1,19 +1,66 @@
 # This file is part aeat_347 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import ModelSQL, ModelView, fields
+from bisect import bisect_right
+from decimal import Decimal
+from collections import defaultdict
+from operator import itemgetter
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, Unique, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
-from sql.operators import In
+from trytond.i18n import gettext
+from trytond.exceptions import UserError
+from sql import Column, Conflict, For, Literal, Null, Select
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Function
+from sql.operators import In, Or
 from .aeat import OPERATION_KEY
+from .tools import (Excluded, batch_update, check_company,
+    clear_loaded_cache, keyset_page)
 ##from trytond.modules.aeat_347.aeat import OPERATION_KEY
 
-__all__ = ['Record', 'Invoice', 'Recalculate347RecordStart',
+__all__ = ['Record', 'RecordSummary', 'PartyTotal', 'PartyChange',
+    'LimitCrossing', 'Invoice', 'Recalculate347RecordStart',
     'Recalculate347RecordEnd', 'Recalculate347Record', 'Reasign347RecordStart',
     'Reasign347RecordEnd', 'Reasign347Record']
 
 
+class TxidCurrent(Function):
+    __slots__ = ()
+    _function = 'TXID_CURRENT'
+
+
+class TxidCurrentSnapshot(Function):
+    __slots__ = ()
+    _function = 'TXID_CURRENT_SNAPSHOT'
+
+
+class TxidSnapshotXmin(Function):
+    __slots__ = ()
+    _function = 'TXID_SNAPSHOT_XMIN'
+
+
+def add_amount(amounts, key, amount, invoice):
+    'Add amount to the total of key in amounts keeping its last invoice'
+    total, last = amounts.get(key, (0, None))
+    amounts[key] = (total + amount, max(last or 0, invoice or 0) or None)
+
+
+def find_rate(rates, currency, date):
+    'Return the rate of the currency at the date from the rates or None'
+    currency_rates = rates.get(currency, [])
+    index = bisect_right(currency_rates, (date, float('inf')))
+    if index:
+        return currency_rates[index - 1][1]
+
+
 class Record(ModelSQL, ModelView):
     """
     AEAT 347 Record
@@ -37,6 +84,8 @@ class Record(ModelSQL, ModelView):
     invoice = fields.Many2One('account.invoice', 'Invoice', readonly=True)
     party_record = fields.Many2One('aeat.347.report.party', 'Party Record',
         readonly=True)
+    property = fields.Many2One('aeat.347.property', 'Property',
+        readonly=True)
     party_name = fields.Function(fields.Char('Party Name'), 'get_party_fields')
     party_vat = fields.Function(fields.Char('Party VAT'), 'get_party_fields')
     country_code = fields.Function(fields.Char('Country Code'),
@@ -46,19 +95,52 @@ class Record(ModelSQL, ModelView):
 
     @classmethod
     def get_party_fields(cls, records, names):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        Address = pool.get('party.address')
+
         res = {}
         for name in ['party_name', 'party_vat', 'country_code',
                 'province_code']:
             res[name] = dict.fromkeys([x.id for x in records], '')
+
+        # The tax identifier and invoice address of all the parties are
+        # searched at once in the order of the party fields
+        types = Party.tax_identifier_types()
+        identifiers = {}
+        addresses = {}
+        invoice_addresses = set()
+        party_ids = list(set(r.party.id for r in records))
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            for identifier in Identifier.search([
+                        ('party', 'in', sub_ids),
+                        ('type', 'in', types),
+                        ]):
+                identifiers.setdefault(identifier.party.id, identifier)
+            for address in Address.search([
+                        ('party', 'in', sub_ids),
+                        ]):
+                party = address.party.id
+                if party in invoice_addresses:
+                    continue
+                if address.invoice:
+                    addresses[party] = address
+                    invoice_addresses.add(party)
+                else:
+                    addresses.setdefault(party, address)
+
         for record in records:
             party = record.party
+            identifier = identifiers.get(party.id)
             res['party_name'][record.id] = party.name[:39]
-            res['party_vat'][record.id] = (party.tax_identifier.code[2:]
-                if party.tax_identifier else '')
-            res['country_code'][record.id] = (party.tax_identifier.code[:2] if
-                party.tax_identifier else '')
+            res['party_vat'][record.id] = (identifier.code[2:]
+                if identifier else '')
+            res['country_code'][record.id] = (identifier.code[:2]
+                if identifier else '')
             province_code = ''
-            address = party.address_get(type='invoice')
+            address = addresses.get(party.id)
             if address and address.zip:
                 province_code = address.zip.strip()[:2]
             res['province_code'][record.id] = province_code
@@ -68,12 +150,548 @@ class Record(ModelSQL, ModelView):
         return res
 
     @classmethod
-    def delete_record(cls, invoices):
+    def __setup__(cls):
+        super(Record, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('invoice_unique', Unique(t, t.invoice),
+                'aeat_347.record_invoice_unique'),
+            ]
+        cls.__rpc__.update({
+                'get_page': RPC(),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        duplicate = cls.__table__()
+
+        # Migration from 5.4: keep only the last record of each invoice
+        if backend.TableHandler.table_exist(cls._table):
+            cursor.execute(*sql_table.delete(
+                    where=(sql_table.invoice != Null)
+                    & ~sql_table.id.in_(duplicate.select(Max(duplicate.id),
+                            where=duplicate.invoice != Null,
+                            group_by=[duplicate.invoice]))))
+
+        super(Record, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        table.index_action(['fiscalyear', 'party', 'operation_key'], 'add')
+        table.index_action(['fiscalyear', 'id'], 'add')
+
+    @classmethod
+    def get_page(cls, fiscalyear, after=None, limit=None,
+            operation_keys=None, quarter=None, party_record=None):
+        '''
+        Return a page of the records of fiscalyear of the company in the
+        context, after the id after, as lists of values by field name.
+        They can be filtered by operation_keys, quarter and party_record.
+        The party VAT and codes are the ones of their party record.
+        Only the records readable by the rules of the user are returned.
+        '''
         pool = Pool()
-        Record = pool.get('aeat.347.record')
-        with Transaction().set_user(0, set_context=True):
-            Record.delete(Record.search([('invoice', 'in',
-                            [i.id for i in invoices])]))
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+        Party = pool.get('party.party')
+        PartyRecord = pool.get('aeat.347.report.party')
+        ModelAccess.check(cls.__name__, 'read')
+        company = Transaction().context.get('company')
+        check_company(company)
+
+        record = cls.__table__()
+        party = Party.__table__()
+        line = PartyRecord.__table__()
+        where = ((record.fiscalyear == fiscalyear)
+            & (record.company == (company or -1))
+            & record.id.in_(Rule.query_get(cls.__name__)))
+        if operation_keys:
+            where &= record.operation_key.in_(operation_keys)
+        if quarter:
+            where &= ((record.month > (quarter - 1) * 3)
+                & (record.month <= quarter * 3))
+        if party_record:
+            where &= ((record.party_record == party_record)
+                & record.party_record.in_(
+                    Rule.query_get(PartyRecord.__name__)))
+        query = record.join(party, condition=record.party == party.id
+            ).join(line, 'LEFT', condition=record.party_record == line.id)
+        columns = [(n, Column(record, n)) for n in ['id', 'month', 'party',
+                'operation_key', 'amount', 'invoice', 'party_record',
+                'property']]
+        columns += [
+            ('party_name', party.name),
+            ('party_vat', line.party_vat),
+            ('country_code', line.country_code),
+            ('province_code', line.province_code),
+            ]
+        return keyset_page(query, record.id, columns, where, after=after,
+            limit=limit)
+
+    @classmethod
+    def delete_record(cls, invoices, amounts=None):
+        '''
+        Delete the records of the invoices and subtract their amounts from the
+        party totals, or from amounts when given to update the totals later.
+        Rows are locked in invoice order before being deleted so concurrent
+        transactions always wait on each other in the same order.
+        '''
+        PartyTotal = Pool().get('aeat.347.party.total')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        invoice_ids = sorted(set(i.id for i in invoices))
+        update_totals = amounts is None
+        if update_totals:
+            amounts = {}
+        for sub_ids in grouped_slice(invoice_ids):
+            sub_ids = list(sub_ids)
+            where = reduce_ids(table.invoice, sub_ids)
+            if transaction.database.has_select_for():
+                cursor.execute(*table.select(table.id, where=where,
+                        order_by=[table.invoice], for_=For('UPDATE')))
+            cls.add_amounts(amounts, sub_ids, sign=-1)
+            cursor.execute(*table.delete(where=where))
+        if update_totals:
+            PartyTotal.update_amounts(amounts)
+
+    @classmethod
+    def add_amounts(cls, amounts, invoice_ids, sign=1, operation_key=None):
+        '''
+        Add to amounts the amount of the records of the invoices by company,
+        fiscal year, party and operation key, or the given operation key
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        for sub_ids in grouped_slice(invoice_ids):
+            cursor.execute(*table.select(table.company, table.fiscalyear,
+                    table.party, table.operation_key, Sum(table.amount),
+                    Max(table.invoice),
+                    where=reduce_ids(table.invoice, list(sub_ids)),
+                    group_by=[table.company, table.fiscalyear, table.party,
+                        table.operation_key]))
+            for (company, fiscalyear, party, key, amount,
+                    invoice) in cursor.fetchall():
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                add_amount(amounts, (company, fiscalyear, party,
+                        operation_key or key), sign * amount, invoice)
+
+    @classmethod
+    def check_archived(cls, keys):
+        '''
+        Raise an error if the records of one of the company and fiscal year
+        ids of keys are archived, as new records would be counted twice
+        with their summaries
+        '''
+        pool = Pool()
+        Summary = pool.get('aeat.347.record.summary')
+        Company = pool.get('company.company')
+        FiscalYear = pool.get('account.fiscalyear')
+        cursor = Transaction().connection.cursor()
+        summary = Summary.__table__()
+
+        for sub_keys in grouped_slice(sorted(set(keys))):
+            cursor.execute(*summary.select(summary.company,
+                    summary.fiscalyear,
+                    where=Or([(summary.company == c)
+                            & (summary.fiscalyear == f)
+                            for c, f in sub_keys]),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                company, fiscalyear = row
+                raise UserError(gettext('aeat_347.archived_records',
+                        company=Company(company).rec_name,
+                        fiscalyear=FiscalYear(fiscalyear).rec_name))
+
+    @classmethod
+    def upsert_records(cls, invoices, vlist):
+        '''
+        Replace the records of the invoices by the ones of vlist.
+        The records are inserted in invoice order with one statement per
+        slice. On PostgreSQL they are inserted or updated on the invoice key,
+        without searching and deleting them first.
+        The party totals are updated with the difference of amounts.
+        '''
+        PartyTotal = Pool().get('aeat.347.party.total')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        vlist = sorted(vlist, key=itemgetter('invoice'))
+
+        cls.check_archived((v['company'], v['fiscalyear']) for v in vlist)
+
+        names = ['company', 'fiscalyear', 'month', 'party', 'operation_key',
+            'amount', 'invoice', 'property']
+        updated = [n for n in names if n != 'invoice']
+        amounts = {}
+        if backend.name == 'postgresql':
+            to_keep = set(v['invoice'] for v in vlist)
+            cls.delete_record([i for i in invoices if i.id not in to_keep],
+                amounts=amounts)
+            cls.add_amounts(amounts, sorted(to_keep), sign=-1)
+            on_conflict = Conflict(table,
+                indexed_columns=[table.invoice],
+                columns=[Column(table, n) for n in updated]
+                + [table.party_record, table.write_uid, table.write_date],
+                values=[Column(Excluded, n) for n in updated]
+                + [Null, transaction.user, CurrentTimestamp()])
+        else:
+            cls.delete_record(invoices, amounts=amounts)
+            on_conflict = None
+        for sub_vlist in grouped_slice(vlist):
+            cursor.execute(*table.insert(
+                    columns=[Column(table, n) for n in names]
+                    + [table.create_uid, table.create_date],
+                    values=[[v.get(n) for n in names]
+                        + [transaction.user, CurrentTimestamp()]
+                        for v in sub_vlist],
+                    on_conflict=on_conflict))
+        for values in vlist:
+            add_amount(amounts, (values['company'], values['fiscalyear'],
+                    values['party'], values['operation_key']),
+                values['amount'], values['invoice'])
+        PartyTotal.update_amounts(amounts)
+
+    @classmethod
+    def archive(cls, company, fiscalyear):
+        '''
+        Replace the records of the company and fiscal year by their quarter
+        summaries by party, operation key and property
+        '''
+        pool = Pool()
+        Summary = pool.get('aeat.347.record.summary')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        summary = Summary.__table__()
+
+        where = ((table.company == company.id)
+            & (table.fiscalyear == fiscalyear.id))
+        quarters = [Sum(Case(((table.month > (q - 1) * 3)
+                        & (table.month <= q * 3), table.amount), else_=0))
+            for q in range(1, 5)]
+        cursor.execute(*summary.insert(
+                columns=[summary.company, summary.fiscalyear, summary.party,
+                    summary.operation_key, summary.property,
+                    summary.first_quarter_amount,
+                    summary.second_quarter_amount,
+                    summary.third_quarter_amount,
+                    summary.fourth_quarter_amount, summary.amount,
+                    summary.record_count, summary.create_uid,
+                    summary.create_date],
+                values=table.select(table.company, table.fiscalyear,
+                    table.party, table.operation_key, table.property,
+                    *(quarters + [Sum(table.amount), Count(Literal('*')),
+                            Literal(transaction.user), CurrentTimestamp()]),
+                    where=where,
+                    group_by=[table.company, table.fiscalyear, table.party,
+                        table.operation_key, table.property])))
+        cursor.execute(*table.delete(where=where))
+
+
+class RecordSummary(ModelSQL, ModelView):
+    """
+    AEAT 347 Record Summary
+
+    Quarter amounts of the records of an archived fiscal year by party,
+    operation key and property.
+    """
+    __name__ = 'aeat.347.record.summary'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True, readonly=True, select=True)
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation key',
+        required=True, readonly=True)
+    property = fields.Many2One('aeat.347.property', 'Property',
+        readonly=True)
+    first_quarter_amount = fields.Numeric('First Quarter Amount',
+        digits=(16, 2), readonly=True)
+    second_quarter_amount = fields.Numeric('Second Quarter Amount',
+        digits=(16, 2), readonly=True)
+    third_quarter_amount = fields.Numeric('Third Quarter Amount',
+        digits=(16, 2), readonly=True)
+    fourth_quarter_amount = fields.Numeric('Fourth Quarter Amount',
+        digits=(16, 2), readonly=True)
+    amount = fields.Numeric('Operation Amount', digits=(16, 2),
+        readonly=True)
+    record_count = fields.Integer('Record Count', readonly=True)
+
+
+class PartyTotal(ModelSQL):
+    """
+    AEAT 347 Party Total
+
+    Total of the 347 records of each party and operation key, aggregated from
+    the records on each read so posting never waits on a shared row.
+    """
+    __name__ = 'aeat.347.party.total'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation key',
+        readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        # Migration from the running totals: they are aggregated on read
+        if backend.TableHandler.table_exist(cls._table):
+            backend.TableHandler.drop_table(cls.__name__, cls._table)
+        super(PartyTotal, cls).__register__(module_name)
+
+    @classmethod
+    def table_query(cls):
+        Record = Pool().get('aeat.347.record')
+        record = Record.__table__()
+        return record.select(
+            Min(record.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            Min(record.create_date).as_('create_date'),
+            Literal(0).as_('write_uid'),
+            Max(record.write_date).as_('write_date'),
+            record.company,
+            record.fiscalyear,
+            record.party,
+            record.operation_key,
+            Sum(record.amount).as_('amount'),
+            group_by=[record.company, record.fiscalyear, record.party,
+                record.operation_key])
+
+    @classmethod
+    def get_totals(cls, keys):
+        '''
+        Return the totals of the records of the company, fiscal year, party
+        and operation key of keys. It reads the records without locking
+        them, using the index on fiscal year, party and operation key.
+        '''
+        Record = Pool().get('aeat.347.record')
+        cursor = Transaction().connection.cursor()
+        record = Record.__table__()
+
+        keys = set(keys)
+        totals = dict.fromkeys(keys, Decimal(0))
+        for sub_keys in grouped_slice(sorted(keys)):
+            cursor.execute(*record.select(record.company, record.fiscalyear,
+                    record.party, record.operation_key, Sum(record.amount),
+                    where=Or([(record.fiscalyear == f) & (record.party == p)
+                            & (record.operation_key == o)
+                            for _, f, p, o in sub_keys]),
+                    group_by=[record.company, record.fiscalyear,
+                        record.party, record.operation_key]))
+            for row in cursor.fetchall():
+                key, amount = tuple(row[:4]), row[4]
+                if key in totals:
+                    if not isinstance(amount, Decimal):
+                        # SQLite sums the numeric columns as floats
+                        amount = round(Decimal(str(amount)),
+                            Record.amount.digits[1])
+                    totals[key] = amount
+        return totals
+
+    @classmethod
+    def update_amounts(cls, amounts):
+        '''
+        Log the change of the parties of the amounts and notify the totals
+        that went over the operation limit with them.
+        amounts is a dictionary by company, fiscal year, party and operation
+        key of the amount added to their records and the last invoice that
+        changed it. It must be called once the records are changed.
+        Concurrent transactions do not wait for each other, so they may both
+        miss a crossing that only their amounts together make.
+        '''
+        pool = Pool()
+        Configuration = pool.get('aeat.347.configuration')
+        Crossing = pool.get('aeat.347.limit.crossing')
+        PartyChange = pool.get('aeat.347.party.change')
+        transaction = Transaction()
+
+        # The records of all the keys changed even if their total did not
+        PartyChange.log(k[:3] for k in amounts)
+        keys = [k for k, (a, _) in amounts.items() if a]
+        if not keys:
+            return
+        totals = cls.get_totals(keys)
+
+        limit = Configuration(1).operation_limit
+        to_create = []
+        for key in sorted(keys):
+            amount, invoice = amounts[key]
+            total = totals[key]
+            if total - amount <= limit < total:
+                company, fiscalyear, party, operation_key = key
+                to_create.append({
+                        'company': company,
+                        'fiscalyear': fiscalyear,
+                        'party': party,
+                        'operation_key': operation_key,
+                        'invoice': invoice,
+                        'amount': total,
+                        'operation_limit': limit,
+                        })
+        if to_create:
+            with transaction.set_user(0, set_context=True):
+                Crossing.create(to_create)
+
+
+class PartyChange(ModelSQL):
+    """
+    AEAT 347 Party Change
+
+    Log of the parties whose 347 party records must be recomputed because
+    their records, cash moves, identifiers or addresses changed. Changes
+    without company and fiscal year are of all the reports.
+    """
+    __name__ = 'aeat.347.party.change'
+
+    company = fields.Many2One('company.company', 'Company',
+        ondelete='CASCADE')
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True,
+        ondelete='CASCADE')
+    txid = fields.BigInteger('Transaction ID', select=True,
+        help='The id of the transaction of the change on PostgreSQL')
+
+    @classmethod
+    def log(cls, changes):
+        '''
+        Log the changes of the company, fiscal year and party ids of changes
+        with one insert statement per slice
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        txid = TxidCurrent() if backend.name == 'postgresql' else Null
+        for sub_changes in grouped_slice(list(set(changes))):
+            cursor.execute(*table.insert(
+                    columns=[table.company, table.fiscalyear, table.party,
+                        table.txid, table.create_uid, table.create_date],
+                    values=[list(c) + [txid, transaction.user,
+                            CurrentTimestamp()] for c in sub_changes]))
+
+    @classmethod
+    def log_parties(cls, party_ids):
+        'Log the change of the parties for all the reports'
+        cls.log((None, None, p) for p in party_ids)
+
+    @classmethod
+    def get_mark(cls):
+        '''
+        Return the mark from which the changes may not be seen by the
+        transaction.
+        On PostgreSQL the ids are not in commit order so it is the oldest
+        transaction still running when the snapshot was taken.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if backend.name == 'postgresql':
+            cursor.execute(*Select([TxidSnapshotXmin(TxidCurrentSnapshot())]))
+        else:
+            cursor.execute(*table.select(Coalesce(Max(table.id), 0) + 1))
+        mark, = cursor.fetchone()
+        return mark
+
+    @classmethod
+    def get_parties(cls, company, fiscalyear, mark):
+        '''
+        Return the ids of the parties changed for the company and fiscal year
+        from mark
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        column = table.txid if backend.name == 'postgresql' else table.id
+        cursor.execute(*table.select(table.party,
+                where=(column >= mark)
+                & ((table.company == company.id) | (table.company == Null))
+                & ((table.fiscalyear == fiscalyear.id)
+                    | (table.fiscalyear == Null)),
+                group_by=[table.party]))
+        return set(p for p, in cursor.fetchall())
+
+    @classmethod
+    def purge(cls, company, fiscalyear):
+        'Delete the changes of the company and fiscal year'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.delete(
+                where=(table.company == company.id)
+                & (table.fiscalyear == fiscalyear.id)))
+
+    @classmethod
+    def purge_unused(cls, mark):
+        '''
+        Delete the changes that no calculated report would read. mark is the
+        one of the current calculation, from which the changes are kept for
+        the fiscal years without calculated report.
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        report = Report.__table__()
+
+        column = table.txid if backend.name == 'postgresql' else table.id
+        calculated = ((report.state == 'calculated')
+            & (report.calculation_mark != Null))
+        cursor.execute(*report.select(report.fiscalyear,
+                Min(report.calculation_mark),
+                where=calculated,
+                group_by=[report.fiscalyear]))
+        marks = dict(cursor.fetchall())
+        cursor.execute(*table.delete(
+                where=(table.fiscalyear != Null) & (column < mark)
+                & ~table.fiscalyear.in_(report.select(report.fiscalyear,
+                        where=calculated))))
+        for fiscalyear, fiscalyear_mark in marks.items():
+            cursor.execute(*table.delete(
+                    where=(table.fiscalyear == fiscalyear)
+                    & (column < fiscalyear_mark)))
+        # The changes without fiscal year are read by all the reports
+        cursor.execute(*table.delete(
+                where=(table.fiscalyear == Null)
+                & (column < min(list(marks.values()) + [mark]))))
+
+
+class LimitCrossing(ModelSQL, ModelView):
+    """
+    AEAT 347 Limit Crossing
+
+    Created when the total of a party and operation key goes over the
+    operation limit.
+    """
+    __name__ = 'aeat.347.limit.crossing'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True, readonly=True)
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation key',
+        required=True, readonly=True)
+    invoice = fields.Many2One('account.invoice', 'Invoice', readonly=True)
+    amount = fields.Numeric('Total Amount', digits=(16, 2), readonly=True)
+    operation_limit = fields.Numeric('Invoiced Limit (1)', digits=(16, 2),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LimitCrossing, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
 
 
 class Invoice(metaclass=PoolMeta):
@@ -81,10 +699,14 @@ class Invoice(metaclass=PoolMeta):
 
     aeat347_operation_key = fields.Selection(OPERATION_KEY,
         'AEAT 347 Operation Key')
+    aeat347_property = fields.Many2One('aeat.347.property',
+        'AEAT 347 Property', domain=[
+            ('company', '=', Eval('company', -1)),
+            ], depends=['company'],
+        help='The leased business premises the invoice is the rent of.')
 
     @classmethod
     def __register__(cls, module_name):
-        cursor = Transaction().connection.cursor()
         table = cls.__table_handler__(module_name)
         sql_table = cls.__table__()
 
@@ -92,16 +714,16 @@ class Invoice(metaclass=PoolMeta):
         super(Invoice, cls).__register__(module_name)
         if exist_347:
             table.drop_column('include_347')
-        cursor.execute(*sql_table.update(
-                columns=[sql_table.aeat347_operation_key],
-                values=['none'],
-                where=(sql_table.aeat347_operation_key == '')
-                | (sql_table.aeat347_operation_key == None)))
+        table.index_action('aeat347_operation_key', 'add')
+        batch_update(sql_table, [sql_table.aeat347_operation_key], ['none'],
+            (sql_table.aeat347_operation_key == '')
+            | (sql_table.aeat347_operation_key == None))
 
     @classmethod
     def __setup__(cls):
         super(Invoice, cls).__setup__()
-        cls._check_modify_exclude += ['aeat347_operation_key']
+        cls._check_modify_exclude += ['aeat347_operation_key',
+            'aeat347_property']
 
     @staticmethod
     def default_aeat347_operation_key():
@@ -120,32 +742,86 @@ class Invoice(metaclass=PoolMeta):
     def get_aeat347_operation_key(cls, invoice_type):
         return 'A' if invoice_type == 'in' else 'B'
 
-    def get_aeat347_total_amount(self):
+    def get_aeat347_total_amount(self, rates=None):
         pool = Pool()
         Currency = pool.get('currency.currency')
 
         amount = 0
-        for tax in self.taxes:
-            if tax.tax.operation_347 in ('ignore', 'exclude_invoice'):
+        for tax, operation in self.get_aeat347_tax_operations():
+            if operation in ('ignore', 'exclude_invoice'):
                 continue
-            if tax.tax.operation_347 == 'amount_only':
+            if operation == 'amount_only':
                 amount += tax.amount
-            elif tax.tax.operation_347 == 'base_amount':
+            elif operation == 'base_amount':
                 amount += (tax.base + tax.amount)
         if amount > self.total_amount:
             amount = self.total_amount
         if self.currency != self.company.currency:
-            with Transaction().set_context(date=self.currency_date):
-                amount = Currency.compute(self.currency, amount,
-                    self.company.currency, round=True)
+            from_rate = to_rate = None
+            if rates is not None:
+                from_rate = find_rate(rates, self.currency.id,
+                    self.currency_date)
+                to_rate = find_rate(rates, self.company.currency.id,
+                    self.currency_date)
+            if from_rate and to_rate:
+                amount = self.company.currency.round(
+                    amount * to_rate / from_rate)
+            else:
+                with Transaction().set_context(date=self.currency_date):
+                    amount = Currency.compute(self.currency, amount,
+                        self.company.currency, round=True)
         return amount
 
+    @classmethod
+    def get_aeat347_currency_rates(cls, invoices):
+        '''
+        Return the rates needed to convert the invoices into the company
+        currency as a dictionary of currency id and sorted (date, rate)
+        '''
+        pool = Pool()
+        Rate = pool.get('currency.currency.rate')
+        cursor = Transaction().connection.cursor()
+
+        currencies = set()
+        dates = set()
+        for invoice in invoices:
+            if invoice.currency != invoice.company.currency:
+                currencies.add(invoice.currency.id)
+                currencies.add(invoice.company.currency.id)
+                dates.add(invoice.currency_date)
+        if not currencies:
+            return {}
+
+        rate = Rate.__table__()
+        previous = Rate.__table__()
+        # Start from the last rate of each currency before the first date
+        start_date = previous.select(Max(previous.date),
+            where=(previous.currency == rate.currency)
+            & (previous.date <= min(dates)))
+        rates = defaultdict(list)
+        cursor.execute(*rate.select(rate.currency, rate.date, rate.rate,
+                where=rate.currency.in_(list(currencies))
+                & (rate.date <= max(dates))
+                & (rate.date >= Coalesce(start_date, min(dates))),
+                order_by=[rate.currency, rate.date]))
+        for currency, date, value in cursor.fetchall():
+            rates[currency].append((date, value))
+        return rates
+
+    def get_aeat347_tax_operations(self):
+        'Return the invoice taxes with their operation for 347'
+        Tax = Pool().get('account.tax')
+        operations = Tax.get_operation_347(
+            [t.tax for t in self.taxes if t.tax])
+        return [(t, operations.get(t.tax.id) if t.tax else None)
+            for t in self.taxes]
+
     def check_347_taxes(self):
         include = False
-        for tax in self.taxes:
-            if tax.tax.operation_347 == 'exclude_invoice':
+        for _, operation in self.get_aeat347_tax_operations():
+            if operation == 'exclude_invoice':
                 return False
-            if tax.tax.operation_347 != 'ignore':
+            if operation != 'ignore':
                 include = True
         return include
 
@@ -159,55 +835,101 @@ class Invoice(metaclass=PoolMeta):
                 self.type)
 
     @classmethod
-    def create_aeat347_records(cls, invoices):
+    def create_aeat347_records(cls, invoices, chunk_size=None):
+        '''
+        Create the 347 records of the invoices processing them in chunks of
+        chunk_size invoices to keep the memory used bounded
+        '''
+        if chunk_size is None:
+            chunk_size = config.getint('aeat_347', 'chunk_size',
+                default=1000)
+        # Sorted to lock the records in the same order on every transaction
+        invoice_ids = sorted(i.id for i in invoices)
+        if len(invoice_ids) <= chunk_size:
+            cls._create_aeat347_records(cls.browse(invoice_ids))
+            return
+        for sub_ids in grouped_slice(invoice_ids, chunk_size):
+            with clear_loaded_cache():
+                cls._create_aeat347_records(cls.browse(list(sub_ids)))
+
+    def get_aeat347_fiscalyear(self, periods=None):
+        '''
+        Return the fiscal year of the 347 record of the posted invoice.
+        periods is a dictionary to cache the periods by company and date.
+        '''
+        Period = Pool().get('account.period')
+        if self.type == 'in':
+            accounting_date = self.accounting_date or self.invoice_date
+            key = (self.company.id, accounting_date)
+            if periods is None:
+                periods = {}
+            if key not in periods:
+                periods[key] = Period(Period.find(
+                        self.company.id, date=accounting_date))
+            return periods[key].fiscalyear
+        return self.move.period.fiscalyear
+
+    @classmethod
+    def check_aeat347_archived(cls, invoices):
+        '''
+        Raise an error if the 347 records of one of the posted invoices are
+        archived, as their summaries would not be updated
+        '''
+        Record = Pool().get('aeat.347.record')
+        periods = {}
+        Record.check_archived((i.company.id,
+                i.get_aeat347_fiscalyear(periods).id) for i in invoices
+            if i.move and i.aeat347_operation_key)
+
+    @classmethod
+    def _create_aeat347_records(cls, invoices):
         pool = Pool()
         Record = pool.get('aeat.347.record')
-        Period = pool.get('account.period')
 
+        rates = cls.get_aeat347_currency_rates(invoices)
+        periods = {}
         to_create = {}
-        to_update = []
+        to_update = defaultdict(list)
         for invoice in invoices:
             if (not invoice.move or invoice.state == 'cancel'):
                 continue
+            operation_key = invoice.aeat347_operation_key
             if not invoice.check_347_taxes():
-                invoice.aeat347_operation_key = None
-                to_update.append(invoice)
+                if operation_key:
+                    to_update[None].append(invoice)
                 continue
-            if not invoice.aeat347_operation_key:
-                invoice.aeat347_operation_key = \
-                    invoice.get_aeat347_operation_key(invoice.type)
-                to_update.append(invoice)
-
-            if invoice.aeat347_operation_key:
-                operation_key = invoice.aeat347_operation_key
-                amount = invoice.get_aeat347_total_amount()
-
-                if invoice.type == 'in':
-                    accounting_date = (invoice.accounting_date
-                        or invoice.invoice_date)
-                    period_id = Period.find(
-                        invoice.company.id, date=accounting_date)
-                    period = Period(period_id)
-                    fiscalyear = period.fiscalyear
-                else:
-                    fiscalyear = invoice.move.period.fiscalyear
+            if not operation_key:
+                operation_key = invoice.get_aeat347_operation_key(
+                    invoice.type)
+                to_update[operation_key].append(invoice)
+
+            if operation_key:
+                amount = invoice.get_aeat347_total_amount(rates=rates)
+
+                fiscalyear = invoice.get_aeat347_fiscalyear(periods)
 
                 to_create[invoice.id] = {
                     'company': invoice.company.id,
-                    'fiscalyear': fiscalyear,
+                    'fiscalyear': fiscalyear.id,
                     'month': invoice.invoice_date.month,
                     'party': invoice.party.id,
                     'amount': amount,
                     'operation_key': operation_key,
                     'invoice': invoice.id,
+                    'property': (invoice.aeat347_property.id
+                        if invoice.aeat347_property else None),
                     }
 
-        Record.delete_record(invoices)
-        with Transaction().set_context(check_modify_invoice=False):
-            cls.save(to_update)
-            #cls.save(cls.browse([x.id for x in to_update]))
-        with Transaction().set_user(0, set_context=True):
-            Record.create(to_create.values())
+        # One write per operation key instead of one per invoice
+        args = []
+        for operation_key, sub_invoices in to_update.items():
+            args.extend((sub_invoices, {
+                        'aeat347_operation_key': operation_key,
+                        }))
+        if args:
+            with Transaction().set_context(check_modify_invoice=False):
+                cls.write(*args)
+        Record.upsert_records(invoices, list(to_create.values()))
 
     @classmethod
     def check_modify(cls, invoices):
@@ -219,6 +941,7 @@ class Invoice(metaclass=PoolMeta):
     def draft(cls, invoices):
         pool = Pool()
         Record = pool.get('aeat.347.record')
+        cls.check_aeat347_archived(invoices)
         super(Invoice, cls).draft(invoices)
         Record.delete_record(invoices)
 
@@ -231,6 +954,7 @@ class Invoice(metaclass=PoolMeta):
     def cancel(cls, invoices):
         pool = Pool()
         Record = pool.get('aeat.347.record')
+        cls.check_aeat347_archived(invoices)
         super(Invoice, cls).cancel(invoices)
         Record.delete_record(invoices)
 
@@ -310,16 +1034,44 @@ class Reasign347Record(Wizard):
             ])
 
     def transition_reasign(self):
-        Invoice = Pool().get('account.invoice')
-        cursor = Transaction().connection.cursor()
-        invoice_ids = Transaction().context['active_ids']
-        invoices = Invoice.browse(invoice_ids)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+        PartyTotal = pool.get('aeat.347.party.total')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        invoice_ids = transaction.context['active_ids']
 
         value = self.start.aeat347_operation_key
         invoice = Invoice.__table__()
+        record = Record.__table__()
         # Update to allow to modify key for posted invoices
-        cursor.execute(*invoice.update(columns=[invoice.aeat347_operation_key,],
+        cursor.execute(*invoice.update(
+                columns=[invoice.aeat347_operation_key],
                 values=[value], where=In(invoice.id, invoice_ids)))
 
-        Invoice.create_aeat347_records(invoices)
+        # Invoices with a record keep being included so only the key of
+        # their record changes. The rest need a full recomputation.
+        to_recompute = set(invoice_ids)
+        if value:
+            amounts = {}
+            for sub_ids in grouped_slice(invoice_ids):
+                sub_ids = list(sub_ids)
+                where = reduce_ids(record.invoice, sub_ids)
+                cursor.execute(*record.select(record.invoice, where=where))
+                to_recompute.difference_update(i for i, in cursor.fetchall())
+                Record.add_amounts(amounts, sub_ids, sign=-1)
+                Record.add_amounts(amounts, sub_ids, operation_key=value)
+                # The party record of the old key is recalculated without
+                # them as update_amounts logs the change of their parties
+                cursor.execute(*record.update(
+                        columns=[record.operation_key, record.party_record,
+                            record.write_uid, record.write_date],
+                        values=[value, Null, transaction.user,
+                            CurrentTimestamp()],
+                        where=where))
+            PartyTotal.update_amounts(amounts)
+
+        if to_recompute:
+            Invoice.create_aeat347_records(Invoice.browse(list(to_recompute)))
         return 'done'
@@ -0,0 +1,27 @@
+# This file is part aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Move']
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Move, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        # Index used to compute the cash received on AEAT 347 reports
+        table.index_action(['journal', 'period', 'state'], 'add')
+
+    @classmethod
+    def post(cls, moves):
+        PartyChange = Pool().get('aeat.347.party.change')
+        super(Move, cls).post(moves)
+        # The cash received from the parties is on the cash journals
+        PartyChange.log((m.company.id, m.period.fiscalyear.id, l.party.id)
+            for m in moves if m.journal.type == 'cash'
+            for l in m.lines if l.party)
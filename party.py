@@ -1,13 +1,19 @@
 # This file is part aeat_347 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from sql import Literal, Null
+from sql.conditionals import Case, Coalesce
 from sql.functions import Substring
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
+from trytond.wizard import Wizard, StateTransition
 from trytond import backend
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
 
-__all__ = ['Party', 'PartyIdentifier']
+from .tools import batch_update
+
+__all__ = ['Party', 'PartyIdentifier', 'Address', 'Recompute347Party']
 
 
 class Party(metaclass=PoolMeta):
@@ -32,7 +38,6 @@ class Party(metaclass=PoolMeta):
 
     @classmethod
     def __register__(cls, module_name):
-        cursor = Transaction().connection.cursor()
         table = backend.TableHandler(cls, module_name)
 
         created_347 = table.column_exist('include_347')
@@ -43,12 +48,92 @@ class Party(metaclass=PoolMeta):
         table = backend.TableHandler(cls, module_name)
         if (not created_347 and table.column_exist('include_347')):
             sql_table = cls.__table__()
-            identifier = Pool().get('party.identifier').__table__()
-            query = identifier.select(identifier.party, where=Substring(
-                    identifier.code, 1, 2) == 'ES')
+            batch_update(sql_table, [sql_table.include_347], [True],
+                sql_table.id.in_(cls._include_347_query()))
+
+    @classmethod
+    def write(cls, *args):
+        PartyChange = Pool().get('aeat.347.party.change')
+        actions = iter(args)
+
+        to_log = set()
+        for parties, vals in zip(actions, actions):
+            if 'name' in vals:
+                to_log.update(p.id for p in parties)
+
+        super(Party, cls).write(*args)
+
+        PartyChange.log_parties(to_log)
+
+    @classmethod
+    def _include_347_query(cls, party_ids=None):
+        'Return the query of the parties with a spanish VAT identifier'
+        identifier = Pool().get('party.identifier').__table__()
+        where = ((identifier.type == 'eu_vat')
+            & (Substring(identifier.code, 1, 2) == 'ES'))
+        if party_ids is not None:
+            where &= reduce_ids(identifier.party, party_ids)
+        return identifier.select(identifier.party, where=where)
+
+    @classmethod
+    def _exclude_347_query(cls, party_ids=None):
+        'Return the query of the parties with a tax rule excluded from 347'
+        pool = Pool()
+        PartyAccount = pool.get('party.party.account')
+        TaxRule = pool.get('account.tax.rule')
+        account = PartyAccount.__table__()
+        customer_rule = TaxRule.__table__()
+        supplier_rule = TaxRule.__table__()
+
+        company = Transaction().context.get('company')
+        query = account.join(customer_rule, 'LEFT',
+            condition=account.customer_tax_rule == customer_rule.id
+            ).join(supplier_rule, 'LEFT',
+            condition=account.supplier_tax_rule == supplier_rule.id)
+        where = ((customer_rule.include_347 == Literal(False))
+            | (supplier_rule.include_347 == Literal(False)))
+        if company:
+            where &= account.company == company
+        if party_ids is not None:
+            where &= reduce_ids(account.party, party_ids)
+        return query.select(account.party, where=where)
+
+    @classmethod
+    def update_include_347(cls, parties=None):
+        '''
+        Compute include on 347 of the parties like on_change_with_include_347:
+        it is unchecked when a tax rule of the party excludes it from 347 and
+        checked when it has a spanish VAT identifier.
+        All the parties are updated if parties is None.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sql_table = cls.__table__()
+
+        # Clean transaction cache
+        for cache in transaction.cache.values():
+            cache.pop(cls.__name__, None)
+
+        def update(party_ids=None):
+            include_347 = Case(
+                (sql_table.id.in_(cls._exclude_347_query(party_ids)),
+                    Literal(False)),
+                (sql_table.id.in_(cls._include_347_query(party_ids)),
+                    Literal(True)),
+                else_=Coalesce(sql_table.include_347, Literal(False)))
+            where = ((include_347 != sql_table.include_347)
+                | (sql_table.include_347 == Null))
+            if party_ids is not None:
+                where &= reduce_ids(sql_table.id, party_ids)
             cursor.execute(*sql_table.update(
-                    columns=[sql_table.include_347], values=[True],
-                    where=(sql_table.id.in_(query))))
+                    columns=[sql_table.include_347], values=[include_347],
+                    where=where))
+
+        if parties is None:
+            update()
+            return
+        for sub_ids in grouped_slice([int(p) for p in parties]):
+            update(list(sub_ids))
 
 
 class PartyIdentifier(metaclass=PoolMeta):
@@ -56,29 +141,92 @@ class PartyIdentifier(metaclass=PoolMeta):
 
     @classmethod
     def create(cls, vlist):
-        Party = Pool().get('party.party')
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyChange = pool.get('aeat.347.party.change')
+        identifiers = super(PartyIdentifier, cls).create(vlist)
+        party_ids = set(i.party.id for i in identifiers)
+        Party.update_include_347(party_ids)
+        PartyChange.log_parties(party_ids)
+        return identifiers
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyChange = pool.get('aeat.347.party.change')
+        actions = iter(args)
+
+        to_update = []
+        for identifiers, vals in zip(actions, actions):
+            if set(vals) & {'type', 'code', 'party'}:
+                to_update.extend(identifiers)
+        party_ids = set(i.party.id for i in to_update)
+
+        super(PartyIdentifier, cls).write(*args)
+
+        if to_update:
+            # The identifiers may have been moved to other parties
+            party_ids.update(i.party.id for i in cls.browse(to_update))
+            Party.update_include_347(party_ids)
+            PartyChange.log_parties(party_ids)
+
+    @classmethod
+    def delete(cls, identifiers):
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyChange = pool.get('aeat.347.party.change')
+        party_ids = set(i.party.id for i in identifiers)
+        super(PartyIdentifier, cls).delete(identifiers)
+        Party.update_include_347(party_ids)
+        PartyChange.log_parties(party_ids)
+
 
-        to_write = []
-        vlist = [x.copy() for x in vlist]
-        for vals in vlist:
-            if (vals.get('type' == 'eu_vat') and vals['code'][:2] == 'ES'):
-                to_write.append(vals['party'])
+class Address(metaclass=PoolMeta):
+    __name__ = 'party.address'
 
-        if to_write:
-            Party.write(to_write, {'include_347': True})
+    # Fields of the address used on the 347 party records
+    _347_fields = {'party', 'zip', 'country', 'invoice', 'active'}
 
-        return super(PartyIdentifier, cls).create(vlist)
+    @classmethod
+    def create(cls, vlist):
+        PartyChange = Pool().get('aeat.347.party.change')
+        addresses = super(Address, cls).create(vlist)
+        PartyChange.log_parties(set(a.party.id for a in addresses))
+        return addresses
 
     @classmethod
     def write(cls, *args):
+        PartyChange = Pool().get('aeat.347.party.change')
         actions = iter(args)
 
-        to_write = []
-        for parties, vals in zip(actions, actions):
-            if (vals.get('type' == 'eu_vat') and vals['code'][:2] == 'ES'):
-                to_write.append(vals['party'])
+        to_log = []
+        for addresses, vals in zip(actions, actions):
+            if set(vals) & cls._347_fields:
+                to_log.extend(addresses)
+        party_ids = set(a.party.id for a in to_log)
 
-        if to_write:
-            Party.write(to_write, {'include_347': True})
+        super(Address, cls).write(*args)
 
-        return super(PartyIdentifier, cls).write(*args)
+        if to_log:
+            party_ids.update(a.party.id for a in cls.browse(to_log))
+            PartyChange.log_parties(party_ids)
+
+    @classmethod
+    def delete(cls, addresses):
+        PartyChange = Pool().get('aeat.347.party.change')
+        party_ids = set(a.party.id for a in addresses)
+        super(Address, cls).delete(addresses)
+        PartyChange.log_parties(party_ids)
+
+
+class Recompute347Party(Wizard):
+    'Recompute Include on 347 of Parties'
+    __name__ = 'aeat.347.party.recompute'
+    start_state = 'recompute'
+    recompute = StateTransition()
+
+    def transition_recompute(self):
+        Party = Pool().get('party.party')
+        Party.update_include_347()
+        return 'end'
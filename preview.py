@@ -0,0 +1,129 @@
+# This file is part aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from decimal import Decimal
+from sql import Literal
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from .aeat import OPERATION_KEY, numeric_literal
+
+__all__ = ['Preview', 'PreviewContext']
+
+
+class Preview(ModelSQL, ModelView):
+    """
+    AEAT 347 Preview
+
+    Amounts of the parties of the fiscal year over or close to the operation
+    limit, aggregated from the 347 records on each read.
+    """
+    __name__ = 'aeat.347.preview'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    operation_key = fields.Selection(OPERATION_KEY, 'Operation Key',
+        readonly=True)
+    first_quarter_amount = fields.Numeric('First Quarter Amount',
+        digits=(16, 2), readonly=True)
+    second_quarter_amount = fields.Numeric('Second Quarter Amount',
+        digits=(16, 2), readonly=True)
+    third_quarter_amount = fields.Numeric('Third Quarter Amount',
+        digits=(16, 2), readonly=True)
+    fourth_quarter_amount = fields.Numeric('Fourth Quarter Amount',
+        digits=(16, 2), readonly=True)
+    amount = fields.Numeric('Operations Amount', digits=(16, 2),
+        readonly=True)
+    record_count = fields.Integer('Record Count', readonly=True)
+    over_limit = fields.Boolean('Over Limit', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Preview, cls).__setup__()
+        cls._order.insert(0, ('amount', 'DESC'))
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        Context = pool.get('aeat.347.preview.context')
+        context = Transaction().context
+
+        record = Record.__table__()
+        limit = context.get('operation_limit')
+        if limit is None:
+            limit = Context.default_operation_limit()
+        limit = Decimal(str(limit))
+        margin = Decimal(str(context.get('margin') or 0))
+        threshold = limit * (1 - margin / 100)
+        fiscalyear = context.get('fiscalyear')
+        if fiscalyear is None:
+            fiscalyear = Context.default_fiscalyear()
+
+        amount = Sum(record.amount)
+        quarters = [Sum(Case(((record.month > (q - 1) * 3)
+                        & (record.month <= q * 3), record.amount), else_=0))
+            for q in range(1, 5)]
+        return record.select(
+            Min(record.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            Min(record.create_date).as_('create_date'),
+            Literal(0).as_('write_uid'),
+            Max(record.write_date).as_('write_date'),
+            record.company,
+            record.fiscalyear,
+            record.party,
+            record.operation_key,
+            quarters[0].as_('first_quarter_amount'),
+            quarters[1].as_('second_quarter_amount'),
+            quarters[2].as_('third_quarter_amount'),
+            quarters[3].as_('fourth_quarter_amount'),
+            amount.as_('amount'),
+            Count(Literal('*')).as_('record_count'),
+            Case((amount > numeric_literal(limit), True),
+                else_=False).as_('over_limit'),
+            where=(record.company == context.get('company', -1))
+            & (record.fiscalyear == (fiscalyear or -1)),
+            group_by=[record.company, record.fiscalyear, record.party,
+                record.operation_key],
+            having=amount > numeric_literal(threshold))
+
+
+class PreviewContext(ModelView):
+    'AEAT 347 Preview Context'
+    __name__ = 'aeat.347.preview.context'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True, domain=[
+            ('company', '=', Eval('company', -1)),
+            ], depends=['company'])
+    operation_limit = fields.Numeric('Invoiced Limit (1)', digits=(16, 2),
+        required=True)
+    margin = fields.Numeric('Margin (%)', digits=(16, 2),
+        help='Also show the parties whose amount is below the limit by less '
+        'than this percentage of it')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_fiscalyear():
+        FiscalYear = Pool().get('account.fiscalyear')
+        return FiscalYear.find(
+            Transaction().context.get('company'), exception=False)
+
+    @staticmethod
+    def default_operation_limit():
+        Report = Pool().get('aeat.347.report')
+        return Report.default_operation_limit()
+
+    @staticmethod
+    def default_margin():
+        return Decimal('10.0')
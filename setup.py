@@ -64,7 +64,7 @@ major_version, minor_version, _ = version.split('.', 2)
 major_version = int(major_version)
 minor_version = int(minor_version)
 
-requires = ['retrofix']
+requires = ['retrofix', 'python-stdnum', 'python-sql >= 1.5']
 
 series = '%s.%s' % (major_version, minor_version)
 if minor_version % 2:
@@ -125,6 +125,9 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'xlsx': ['openpyxl'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
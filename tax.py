@@ -1,9 +1,10 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
-__all__ = ['TaxTemplate', 'Tax']
+__all__ = ['TaxTemplate', 'Tax', 'TaxRule']
 
 OPERATION_347 = [
     (None, ''),
@@ -27,6 +28,7 @@ class TaxTemplate(metaclass=PoolMeta):
 
         if not tax or tax.operation_347 != self.operation_347:
             res['operation_347'] = self.operation_347
+            Pool().get('account.tax')._operation_347_cache.clear()
         return res
 
 
@@ -34,3 +36,46 @@ class Tax(metaclass=PoolMeta):
     __name__ = 'account.tax'
 
     operation_347 = fields.Selection(OPERATION_347, 'Operation for 347')
+    _operation_347_cache = Cache('account.tax.operation_347', context=False)
+
+    @classmethod
+    def get_operation_347(cls, taxes):
+        'Return a dictionary with the operation for 347 of each tax id'
+        result = {}
+        missing = []
+        for tax_id in set(map(int, taxes)):
+            operation = cls._operation_347_cache.get(tax_id, -1)
+            if operation == -1:
+                missing.append(tax_id)
+            else:
+                result[tax_id] = operation
+        for tax in cls.browse(missing):
+            result[tax.id] = tax.operation_347
+            cls._operation_347_cache.set(tax.id, tax.operation_347)
+        return result
+
+    @classmethod
+    def create(cls, vlist):
+        cls._operation_347_cache.clear()
+        return super(Tax, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Tax, cls).write(*args)
+        cls._operation_347_cache.clear()
+
+    @classmethod
+    def delete(cls, taxes):
+        super(Tax, cls).delete(taxes)
+        cls._operation_347_cache.clear()
+
+
+class TaxRule(metaclass=PoolMeta):
+    __name__ = 'account.tax.rule'
+
+    include_347 = fields.Boolean('Include on 347', help='Parties using this '
+        'rule are not included on 347 when unchecked.')
+
+    @staticmethod
+    def default_include_347():
+        return True
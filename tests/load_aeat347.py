@@ -0,0 +1,387 @@
+# This file is part of the aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Load test of the AEAT 347 hooks of account.invoice post, draft and cancel.
+
+It runs against an existing PostgreSQL database with aeat_347 activated and
+a company with a fiscal year, invoice sequences, an expense or revenue
+account and a tax with an operation for 347. Each worker thread runs in its
+own transactions:
+
+    python trytond/modules/aeat_347/tests/load_aeat347.py \\
+        -c trytond.conf -d DATABASE --threads 8 --invoices 200 --rate 20
+
+Every invoice is created, validated and drafted, posted and, when the
+company allows it, cancelled. The operations are retried on operational
+errors like the server does. At the end latency percentiles per operation,
+retries, lock waits, deadlocks and aeat_347_record counts are reported and the
+records are checked against the invoices. The exit status is 1 when a
+deadlock or an inconsistency is found.
+
+The lock waits of the sessions running a statement on the 347 tables are
+reported apart; run with --parties 1 to check that the posts of the same
+party do not wait for each other.
+"""
+import argparse
+import datetime
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+NIF_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', dest='config',
+        help='trytond configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('--company', type=int,
+        help='company id (default: the first one)')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--invoices', type=int, default=50,
+        help='invoices per thread')
+    parser.add_argument('--rate', type=float, default=0,
+        help='maximum operations per second and thread (0: unlimited)')
+    parser.add_argument('--parties', type=int, default=10,
+        help='number of parties shared by the threads')
+    parser.add_argument('--type', choices=['in', 'out'], default='in',
+        help='invoice type')
+    parser.add_argument('--lock-interval', type=float, default=0.1,
+        help='seconds between lock samples')
+    return parser.parse_args(args)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100. * len(values))))
+    return values[index]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.retries = Counter()
+        self.invoices = []
+        self.lock_samples = 0
+        self.lock_waits = 0
+        self.max_lock_waits = 0
+        self.aeat347_lock_waits = 0
+        self.max_aeat347_lock_waits = 0
+
+    def add_latency(self, operation, seconds):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+
+    def add_error(self, operation, exception):
+        code = getattr(exception, 'pgcode', None) or type(exception).__name__
+        with self.lock:
+            self.errors[(operation, code)] += 1
+
+    def add_retry(self, operation):
+        with self.lock:
+            self.retries[operation] += 1
+
+    def add_invoice(self, invoice_id):
+        with self.lock:
+            self.invoices.append(invoice_id)
+
+
+class LoadTest(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.done = threading.Event()
+        self.company = None
+
+    def start(self, readonly=False):
+        from trytond.transaction import Transaction
+        return Transaction().start(self.args.database, 0, readonly=readonly,
+            context={'company': self.company})
+
+    def setup(self):
+        from trytond.pool import Pool
+        pool = Pool()
+        Company = pool.get('company.company')
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Tax = pool.get('account.tax')
+        Party = pool.get('party.party')
+
+        if self.args.company:
+            company = Company(self.args.company)
+        else:
+            company, = Company.search([], limit=1)
+        self.company = company.id
+        self.currency = company.currency.id
+        self.cancel = self.args.type == 'in' or company.cancel_invoice_out
+
+        kind = 'expense' if self.args.type == 'in' else 'revenue'
+        account, = Account.search([
+                ('company', '=', company.id),
+                ('type.%s' % kind, '=', True),
+                ], limit=1)
+        self.account = account.id
+        journal, = Journal.search([('type', '=', kind)], limit=1)
+        self.journal = journal.id
+        tax, = Tax.search([
+                ('company', '=', company.id),
+                ('operation_347', '=', 'base_amount'),
+                ], limit=1)
+        self.tax = tax.id
+
+        parties = []
+        for i in range(self.args.parties):
+            number = random.randrange(10 ** 7, 10 ** 8)
+            party = Party(name='AEAT 347 Load Test %s' % number)
+            party.addresses = [{
+                    'zip': '08%03d' % (number % 1000),
+                    }]
+            party.identifiers = [{
+                    'type': 'eu_vat',
+                    'code': 'ES%s%s' % (number, NIF_LETTERS[number % 23]),
+                    }]
+            parties.append(party)
+        Party.save(parties)
+        self.parties = [p.id for p in parties]
+
+    def create_invoice(self):
+        from trytond.pool import Pool
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        Party = pool.get('party.party')
+
+        party = Party(random.choice(self.parties))
+        invoice = Invoice(company=self.company, type=self.args.type,
+            party=party, currency=self.currency, journal=self.journal,
+            invoice_date=datetime.date.today())
+        invoice.on_change_party()
+        if self.args.type == 'in':
+            invoice.account = party.account_payable_used
+        else:
+            invoice.account = party.account_receivable_used
+        invoice.lines = [Line(company=self.company, type='line',
+                invoice_type=self.args.type, party=party,
+                currency=self.currency, account=self.account,
+                description='AEAT 347 load test', quantity=1,
+                unit_price=Decimal(random.randint(100, 5000)),
+                taxes=[self.tax])]
+        invoice.save()
+        Invoice.update_taxes([invoice])
+        return invoice.id
+
+    def run_operation(self, operation, function, *args):
+        from trytond import backend
+        from trytond.config import config
+        from trytond.pool import Pool
+        # Retried on operational errors like the dispatcher of the server
+        retry = config.getint('database', 'retry')
+        start = time.monotonic()
+        for count in range(retry, -1, -1):
+            if count != retry:
+                time.sleep(0.02 * (retry - count))
+            try:
+                with self.start():
+                    Invoice = Pool().get('account.invoice')
+                    result = function(Invoice, *args)
+            except backend.DatabaseOperationalError as exception:
+                if count:
+                    self.stats.add_retry(operation)
+                    continue
+                self.stats.add_error(operation, exception)
+                return None, False
+            except Exception as exception:
+                self.stats.add_error(operation, exception)
+                return None, False
+            break
+        self.stats.add_latency(operation, time.monotonic() - start)
+        return result, True
+
+    def worker(self):
+        if self.args.rate:
+            period = 1. / self.args.rate
+        else:
+            period = 0
+
+        def pace():
+            if period:
+                time.sleep(max(0, period - (time.monotonic() - started)))
+
+        for _ in range(self.args.invoices):
+            started = time.monotonic()
+            invoice_id, ok = self.run_operation('create',
+                lambda Invoice: self.create_invoice())
+            pace()
+            if not ok:
+                continue
+            self.stats.add_invoice(invoice_id)
+            operations = [
+                ('validate', lambda Invoice, i: Invoice.validate_invoice(
+                        [Invoice(i)])),
+                ('draft', lambda Invoice, i: Invoice.draft([Invoice(i)])),
+                ('post', lambda Invoice, i: Invoice.post([Invoice(i)])),
+                ]
+            if self.cancel:
+                operations.append(
+                    ('cancel', lambda Invoice, i: Invoice.cancel(
+                            [Invoice(i)])))
+            for operation, function in operations:
+                started = time.monotonic()
+                _, ok = self.run_operation(operation, function, invoice_id)
+                pace()
+                if not ok:
+                    break
+
+    def monitor(self):
+        from trytond.transaction import Transaction
+        while not self.done.is_set():
+            with self.start(readonly=True):
+                cursor = Transaction().connection.cursor()
+                cursor.execute('SELECT count(*), '
+                    'count(*) FILTER (WHERE a.query LIKE %s) '
+                    'FROM pg_locks AS l '
+                    'LEFT JOIN pg_stat_activity AS a ON a.pid = l.pid '
+                    'WHERE NOT l.granted', ('%aeat_347%',))
+                waiting, aeat347_waiting = cursor.fetchone()
+            with self.stats.lock:
+                self.stats.lock_samples += 1
+                if waiting:
+                    self.stats.lock_waits += 1
+                self.stats.max_lock_waits = max(
+                    self.stats.max_lock_waits, waiting)
+                if aeat347_waiting:
+                    self.stats.aeat347_lock_waits += 1
+                self.stats.max_aeat347_lock_waits = max(
+                    self.stats.max_aeat347_lock_waits, aeat347_waiting)
+            self.done.wait(self.args.lock_interval)
+
+    def deadlocks(self):
+        from trytond.transaction import Transaction
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT deadlocks FROM pg_stat_database '
+            'WHERE datname = current_database()')
+        count, = cursor.fetchone()
+        return count
+
+    def check(self):
+        'Return the list of inconsistencies between invoices and records'
+        from trytond.pool import Pool
+        from trytond.tools import grouped_slice
+        from trytond.transaction import Transaction
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+        cursor = Transaction().connection.cursor()
+        record = Record.__table__()
+
+        errors = []
+        total = 0
+        for sub_ids in grouped_slice(self.stats.invoices):
+            invoices = Invoice.browse(list(sub_ids))
+            cursor.execute(*record.select(record.invoice,
+                    record.operation_key, record.amount,
+                    where=record.invoice.in_([i.id for i in invoices])))
+            records = defaultdict(list)
+            for invoice_id, operation_key, amount in cursor.fetchall():
+                records[invoice_id].append((operation_key, amount))
+                total += 1
+            for invoice in invoices:
+                invoice_records = records.get(invoice.id, [])
+                if len(invoice_records) > 1:
+                    errors.append('%s: %s records' % (
+                            invoice.rec_name, len(invoice_records)))
+                elif (invoice.state in {'posted', 'paid'}
+                        and invoice.aeat347_operation_key):
+                    if not invoice_records:
+                        errors.append('%s: missing record' % invoice.rec_name)
+                        continue
+                    (operation_key, amount), = invoice_records
+                    if operation_key != invoice.aeat347_operation_key:
+                        errors.append('%s: wrong operation key %s' % (
+                                invoice.rec_name, operation_key))
+                    if amount != invoice.get_aeat347_total_amount():
+                        errors.append('%s: wrong amount %s' % (
+                                invoice.rec_name, amount))
+                elif invoice_records:
+                    errors.append('%s: record on %s invoice' % (
+                            invoice.rec_name, invoice.state))
+        return total, errors
+
+    def run(self):
+        with self.start():
+            self.setup()
+            deadlocks = self.deadlocks()
+
+        monitor = threading.Thread(target=self.monitor)
+        monitor.start()
+        workers = [threading.Thread(target=self.worker)
+            for _ in range(self.args.threads)]
+        started = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started
+        self.done.set()
+        monitor.join()
+
+        with self.start(readonly=True):
+            deadlocks = self.deadlocks() - deadlocks
+            total, errors = self.check()
+        self.report(elapsed, deadlocks, total, errors)
+        return not deadlocks and not errors
+
+    def report(self, elapsed, deadlocks, total, errors):
+        stats = self.stats
+        print('%s threads, %s invoices in %.1fs' % (
+                self.args.threads, len(stats.invoices), elapsed))
+        print('%-10s %8s %8s %8s %8s %8s' % (
+                'operation', 'count', 'p50', 'p90', 'p99', 'max'))
+        for operation, latencies in sorted(stats.latencies.items()):
+            print('%-10s %8s %8.3f %8.3f %8.3f %8.3f' % (operation,
+                    len(latencies), percentile(latencies, 50),
+                    percentile(latencies, 90), percentile(latencies, 99),
+                    max(latencies)))
+        print('lock waits: %s of %s samples (max %s waiting)' % (
+                stats.lock_waits, stats.lock_samples, stats.max_lock_waits))
+        print('347 lock waits: %s of %s samples (max %s waiting)' % (
+                stats.aeat347_lock_waits, stats.lock_samples,
+                stats.max_aeat347_lock_waits))
+        print('deadlocks: %s' % deadlocks)
+        for operation, count in sorted(stats.retries.items()):
+            print('retries on %s: %s' % (operation, count))
+        for (operation, code), count in sorted(stats.errors.items()):
+            print('error %s on %s: %s' % (code, operation, count))
+        print('aeat_347_record rows: %s' % total)
+        print('inconsistencies: %s' % len(errors))
+        for error in errors:
+            print('  %s' % error)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    from trytond.config import config
+    if args.config:
+        config.update_etc(args.config)
+    from trytond import backend
+    from trytond.pool import Pool
+    if backend.name != 'postgresql':
+        sys.exit('The load test requires a PostgreSQL database')
+    Pool(args.database).init()
+    return 0 if LoadTest(args).run() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
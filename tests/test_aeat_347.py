@@ -1,18 +1,1221 @@
 # This file is part of the aeat_347 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import io
 import unittest
 import doctest
+import datetime
+import logging
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+from unittest.mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+from trytond.modules.currency.tests import (create_currency,
+    add_currency_rate)
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+
+NIF_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+
+
+class QueryCounter(logging.Handler):
+    'Count the queries logged by the cursor of the PostgreSQL backend'
+
+    def __init__(self, match=None):
+        super(QueryCounter, self).__init__(logging.DEBUG)
+        self.count = 0
+        self.match = match
+
+    def emit(self, record):
+        if record.funcName == 'execute':
+            statement = record.msg
+            if isinstance(statement, bytes):
+                statement = statement.decode('utf-8', 'replace')
+            self.trace(statement)
+
+    def trace(self, statement):
+        if self.match is None or self.match in statement:
+            self.count += 1
+
+
+@contextmanager
+def count_queries(match=None):
+    """
+    Count the SQL statements executed on the connection of the transaction
+    inside the block, only those containing match if it is set. The result
+    is on the count attribute of the counter.
+    """
+    counter = QueryCounter(match)
+    connection = Transaction().connection
+    if backend.name == 'sqlite':
+        connection.set_trace_callback(counter.trace)
+        try:
+            yield counter
+        finally:
+            connection.set_trace_callback(None)
+    else:
+        logger = logging.getLogger('trytond.backend.postgresql.database')
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(counter)
+        try:
+            yield counter
+        finally:
+            logger.removeHandler(counter)
+            logger.setLevel(level)
 
 
 class Aeat347TestCase(ModuleTestCase):
     'Test Aeat 347 module'
     module = 'aeat_347'
 
+    def test_check_vat(self):
+        'Test check_vat'
+        from trytond.modules.aeat_347.aeat import check_vat
+        for party_vat, community_vat, country_code, result in [
+                ('00000000T', '', 'ES', None),
+                ('B58378431', '', 'ES', None),
+                ('X1234567L', '', 'ES', None),
+                ('00000000A', '', 'ES', 'invalid_party_vat'),
+                ('', '', 'ES', 'missing_party_vat'),
+                ('', '40303265045', 'FR', None),
+                ('', '40303265040', 'FR', 'invalid_community_vat'),
+                ('', '123-456', 'US', 'invalid_community_vat'),
+                ('', '123456', 'US', None),
+                ]:
+            self.assertEqual(
+                check_vat(party_vat, community_vat, country_code), result)
+
+    def create_parties(self, number, start=1):
+        pool = Pool()
+        Party = pool.get('party.party')
+        return Party.create([{
+                    'name': 'Party %s' % n,
+                    'addresses': [('create', [{
+                                    'zip': '08%03d' % n,
+                                    }])],
+                    'identifiers': [('create', [{
+                                    'type': 'eu_vat',
+                                    'code': 'ES%08d%s' % (n,
+                                        NIF_LETTERS[n % 23]),
+                                    }])],
+                    } for n in range(start, start + number)])
+
+    def create_invoices(self, company, parties, number, post=True):
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Tax = pool.get('account.tax')
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+        tax, = Tax.search([('company', '=', company.id)], limit=1)
+        tax.operation_347 = 'base_amount'
+        tax.save()
+
+        invoices = []
+        for i in range(number):
+            party = parties[i % len(parties)]
+            invoices.append(Invoice(company=company, type='out',
+                    party=party, invoice_address=party.addresses[0],
+                    currency=company.currency, journal=journal,
+                    account=receivable, invoice_date=datetime.date.today(),
+                    lines=[Line(company=company, type='line',
+                            account=revenue, description='Line',
+                            quantity=1, unit_price=Decimal(5000),
+                            taxes=[tax])]))
+        Invoice.save(invoices)
+        if post:
+            Invoice.post(invoices)
+        return invoices
+
+    def setup_company(self):
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Currency = pool.get('currency.currency')
+
+        # The reports must be in Euro
+        currencies = Currency.search([('code', '=', 'EUR')], limit=1)
+        if currencies:
+            currency, = currencies
+        else:
+            currency = create_currency('EUR')
+            add_currency_rate(currency, 1)
+        company = create_company(currency=currency)
+        with set_company(company):
+            create_chart(company, tax=True)
+            fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+        return company, fiscalyear
+
+    @with_transaction()
+    def test_create_records_queries(self):
+        'Test the 347 queries to post invoices do not grow with the invoices'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+
+        company, _ = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            # Fill the caches of the posting of the invoices
+            self.create_invoices(company, parties, 2)
+
+            def post(number, hooks=True):
+                invoices = Invoice.browse([i.id for i in self.create_invoices(
+                            company, parties, number, post=False)])
+                with ExitStack() as stack:
+                    if not hooks:
+                        stack.enter_context(
+                            patch.object(Invoice, 'create_aeat347_records'))
+                    counter = stack.enter_context(count_queries())
+                    Invoice.post(invoices)
+                return counter.count, invoices
+
+            # The statements added by the 347 hooks to all those of posting
+            extras = []
+            for number in [2, 20]:
+                count, invoices = post(number)
+                base_count, _ = post(number, hooks=False)
+                extras.append(count - base_count)
+            self.assertGreater(extras[0], 0)
+            self.assertLessEqual(extras[1], extras[0])
+            self.assertLessEqual(extras[1], 30)
+            self.assertEqual(Record.search([], count=True), 24)
+
+            with count_queries() as counter:
+                Invoice.create_aeat347_records(Invoice.browse(
+                        [i.id for i in invoices]))
+            self.assertLessEqual(counter.count, 15)
+            self.assertEqual(Record.search([], count=True), 24)
+
+    @with_transaction()
+    def test_create_records_chunks(self):
+        'Test the 347 records created by chunks are the same'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+        Party = pool.get('party.party')
+
+        company, _ = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(3)
+            invoices = self.create_invoices(company, parties, 6)
+
+            def create_records(chunk_size):
+                Record.delete(Record.search([]))
+                Invoice.create_aeat347_records(Invoice.browse(
+                        [i.id for i in invoices]), chunk_size=chunk_size)
+                return sorted((r.invoice.id, r.party.id, r.fiscalyear.id,
+                        r.month, r.operation_key, r.amount)
+                    for r in Record.search([]))
+
+            records = create_records(None)
+            self.assertEqual(len(records), 6)
+            party = Party(parties[0].id)
+            party.name
+            self.assertEqual(create_records(1), records)
+            # The records cached before the chunks are kept
+            self.assertIn(party.id, Transaction().get_cache()['party.party'])
+
+    @with_transaction()
+    def test_tax_operation_cache(self):
+        'Test the cached 347 operation of taxes follows their changes'
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+
+        company, _ = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(1)
+            invoice, = self.create_invoices(company, parties, 1)
+            tax, = [t.tax for t in invoice.taxes]
+            self.assertTrue(Record.search([('invoice', '=', invoice.id)]))
+
+            def cached(tax):
+                return Tax._operation_347_cache.get(tax.id, -1) != -1
+
+            # The next post uses the written operation
+            invoice, = self.create_invoices(company, parties, 1, post=False)
+            self.assertEqual(Tax.get_operation_347([tax]),
+                {tax.id: 'base_amount'})
+            self.assertTrue(cached(tax))
+            Tax.write([tax], {'operation_347': 'exclude_invoice'})
+            self.assertFalse(cached(tax))
+            Invoice.post([invoice])
+            self.assertIsNone(Invoice(invoice.id).aeat347_operation_key)
+            self.assertFalse(Record.search([('invoice', '=', invoice.id)]))
+
+            # And the one updated from the template
+            invoice, = self.create_invoices(company, parties, 1, post=False)
+            self.assertEqual(Tax.get_operation_347([tax]),
+                {tax.id: 'base_amount'})
+            template = tax.template
+            template.operation_347 = 'exclude_invoice'
+            values = template._get_tax_value(tax=Tax(tax.id))
+            self.assertEqual(values['operation_347'], 'exclude_invoice')
+            self.assertFalse(cached(tax))
+            Tax.write([tax], values)
+            Invoice.post([invoice])
+            self.assertFalse(Record.search([('invoice', '=', invoice.id)]))
+
+            # Creating or deleting taxes also clears the cache
+            Tax.get_operation_347([tax])
+            new, = Tax.copy([tax])
+            self.assertFalse(cached(tax))
+            self.assertEqual(Tax.get_operation_347([tax, new]), {
+                    tax.id: 'exclude_invoice',
+                    new.id: 'exclude_invoice',
+                    })
+            Tax.delete([new])
+            self.assertFalse(cached(tax))
+
+    @with_transaction()
+    def test_currency_rates(self):
+        'Test the 347 amounts of foreign currency invoices'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Record = pool.get('aeat.347.record')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            usd = create_currency('USD')
+            start = fiscalyear.start_date
+            add_currency_rate(company.currency, 1,
+                start - datetime.timedelta(days=1))
+            for days, rate in [(-1, '1.1'), (60, '1.25'), (150, '1.4')]:
+                add_currency_rate(usd, Decimal(rate),
+                    start + datetime.timedelta(days=days))
+            parties = self.create_parties(2)
+            invoices = self.create_invoices(company, parties, 5, post=False)
+            for invoice, days in zip(invoices, [0, 10, 60, 100, 200]):
+                invoice.currency = usd
+                invoice.invoice_date = start + datetime.timedelta(days=days)
+            Invoice.save(invoices)
+            Invoice.post(invoices)
+
+            # The rates loaded at once give the amounts of Currency.compute
+            invoices = Invoice.browse([i.id for i in invoices])
+            rates = Invoice.get_aeat347_currency_rates(invoices)
+            amounts = [i.get_aeat347_total_amount() for i in invoices]
+            self.assertEqual(
+                [i.get_aeat347_total_amount(rates=rates) for i in invoices],
+                amounts)
+            self.assertEqual(len(set(amounts)), 3)
+            records = dict((r.invoice, r.amount) for r in Record.search([]))
+            self.assertEqual([records[i] for i in invoices], amounts)
+
+    @with_transaction()
+    def test_upsert_records(self):
+        'Test the records of posted invoices are replaced in place'
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        PartyTotal = pool.get('aeat.347.party.total')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(1)
+            invoice, = self.create_invoices(company, parties, 1)
+            record, = Record.search([])
+
+            # On PostgreSQL it updates the record of the invoice on conflict
+            Record.upsert_records([invoice], [{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'month': record.month,
+                        'party': parties[0].id,
+                        'operation_key': 'A',
+                        'amount': Decimal('7000.00'),
+                        'invoice': invoice.id,
+                        'property': None,
+                        }])
+            updated, = Record.search([])
+            if backend.name == 'postgresql':
+                self.assertEqual(updated.id, record.id)
+            self.assertEqual((updated.operation_key, updated.amount),
+                ('A', Decimal('7000.00')))
+            self.assertEqual([(t.operation_key, t.amount)
+                    for t in PartyTotal.search([])],
+                [('A', Decimal('7000.00'))])
+
+    @with_transaction()
+    def test_operation_limit(self):
+        'Test calculate only includes the parties over the operation limit'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 3)
+            for limit, result in [
+                    (Decimal('6000.00'), [parties[0].name]),
+                    (Decimal('5999.99'), [parties[0].name, parties[1].name]),
+                    (Decimal('12000.00'), []),
+                    ]:
+                report, = Report.create([{
+                            'company': company.id,
+                            'fiscalyear': fiscalyear.id,
+                            'fiscalyear_code': fiscalyear.start_date.year,
+                            'company_vat': '00000000T',
+                            'operation_limit': limit,
+                            }])
+                Report.calculate([report])
+                self.assertEqual(
+                    sorted(l.party_name for l in report.parties), result)
+
+    @with_transaction()
+    def test_cash_amounts(self):
+        'Test the cash received over the limit on the cash journals'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        Report = pool.get('aeat.347.report')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 2)
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('company', '=', company.id),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('company', '=', company.id),
+                    ], limit=1)
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+            today = datetime.date.today()
+            period = Period(Period.find(company.id, date=today))
+            moves = []
+            for party, amount in zip(parties,
+                    [Decimal('6500.00'), Decimal('1000.00')]):
+                moves.append(Move(period=period, journal=journal,
+                        date=today, lines=[{
+                                'account': receivable.id,
+                                'party': party.id,
+                                'credit': amount,
+                                }, {
+                                'account': revenue.id,
+                                'debit': amount,
+                                }]))
+            Move.save(moves)
+            Move.post(moves)
+
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            self.assertEqual(report.cash_journals, (journal,))
+            Report.calculate([report])
+            self.assertEqual(sorted((l.party_name, l.cash_amount,
+                        l.fiscalyear_code_cash_operation)
+                    for l in report.parties), [
+                    (parties[0].name, Decimal('6500.00'),
+                        fiscalyear.start_date.year),
+                    (parties[1].name, Decimal('0.00'), None),
+                    ])
+
+    @with_transaction()
+    def test_preview(self):
+        'Test preview'
+        pool = Pool()
+        Preview = pool.get('aeat.347.preview')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 3)
+            for margin, result in [
+                    (0, [(parties[0], Decimal('12000.00'), 2, True)]),
+                    (50, [(parties[0], Decimal('12000.00'), 2, True),
+                            (parties[1], Decimal('6000.00'), 1, False)]),
+                    ]:
+                with Transaction().set_context(fiscalyear=fiscalyear.id,
+                        operation_limit=Decimal('10000'), margin=margin):
+                    previews = Preview.search([])
+                    self.assertEqual([(p.party, p.amount, p.record_count,
+                                p.over_limit) for p in previews], result)
+
+    @with_transaction()
+    def test_limit_crossing(self):
+        'Test limit crossing'
+        pool = Pool()
+        Configuration = pool.get('aeat.347.configuration')
+        PartyTotal = pool.get('aeat.347.party.total')
+        Crossing = pool.get('aeat.347.limit.crossing')
+
+        company, fiscalyear = self.setup_company()
+        Configuration.create([{'operation_limit': Decimal('10000')}])
+        with set_company(company):
+            parties = self.create_parties(2)
+            invoice1, invoice2 = self.create_invoices(
+                company, parties[:1], 2)
+            self.create_invoices(company, parties[1:], 1)
+
+            totals = PartyTotal.search([], order=[('party', 'ASC')])
+            self.assertEqual([(t.party, t.operation_key, t.amount)
+                    for t in totals], [
+                    (parties[0], 'B', Decimal('12000.00')),
+                    (parties[1], 'B', Decimal('6000.00')),
+                    ])
+            crossing, = Crossing.search([])
+            self.assertEqual(crossing.party, parties[0])
+            self.assertEqual(crossing.fiscalyear, fiscalyear)
+            self.assertEqual(crossing.invoice, invoice2)
+            self.assertEqual(crossing.amount, Decimal('12000.00'))
+
+    @with_transaction()
+    def test_archive(self):
+        'Test the report calculated from archived records'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        Record = pool.get('aeat.347.record')
+        Summary = pool.get('aeat.347.record.summary')
+        Invoice = pool.get('account.invoice')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            invoices = self.create_invoices(company, self.create_parties(2),
+                3)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+
+            def get_lines():
+                Report.calculate([report])
+                lines = [(p.party_vat, p.operation_key, p.amount,
+                        p.first_quarter_amount, p.second_quarter_amount,
+                        p.third_quarter_amount, p.fourth_quarter_amount)
+                    for p in Report(report.id).parties]
+                Report.draft([report])
+                return sorted(lines)
+
+            lines = get_lines()
+            self.assertEqual(len(lines), 2)
+            Record.archive(company, fiscalyear)
+            self.assertEqual(Record.search([], count=True), 0)
+            self.assertEqual(Summary.search([], count=True), 2)
+            self.assertEqual(get_lines(), lines)
+
+            # The invoices are not counted again next to their summaries
+            with self.assertRaises(UserError):
+                Invoice.create_aeat347_records(invoices)
+            self.assertEqual(Record.search([], count=True), 0)
+
+            # Nor removed from them
+            company.cancel_invoice_out = True
+            company.save()
+            with self.assertRaisesRegex(UserError, 'archived'):
+                Invoice.cancel(invoices[:1])
+            self.assertEqual(Invoice(invoices[0].id).state, 'posted')
+            self.assertEqual(get_lines(), lines)
+
+    @with_transaction()
+    def test_include_347(self):
+        'Test include on 347 of parties follows identifiers and tax rules'
+        pool = Pool()
+        Party = pool.get('party.party')
+        TaxRule = pool.get('account.tax.rule')
+
+        company, _ = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            foreign, = Party.create([{
+                        'name': 'Foreign',
+                        'identifiers': [('create', [{
+                                        'type': 'eu_vat',
+                                        'code': 'FR40303265045',
+                                        }])],
+                        }])
+            self.assertEqual([p.include_347 for p in parties + [foreign]],
+                [True, True, False])
+
+            rule, = TaxRule.create([{
+                        'name': 'Excluded',
+                        'kind': 'sale',
+                        'company': company.id,
+                        'include_347': False,
+                        }])
+            parties[0].customer_tax_rule = rule
+            parties[0].save()
+            Party.write([parties[0]], {'include_347': True})
+            Party.update_include_347()
+            self.assertEqual(
+                [p.include_347 for p in Party.browse(parties + [foreign])],
+                [False, True, False])
+
+            parties[1].identifiers[0].code = 'FR40303265045'
+            parties[1].identifiers[0].save()
+            self.assertTrue(Party(parties[1].id).include_347)
+            parties[0].customer_tax_rule = None
+            parties[0].save()
+            Party.update_include_347([parties[0]])
+            self.assertTrue(Party(parties[0].id).include_347)
+
+    @with_transaction()
+    def test_incremental_calculate(self):
+        'Test calculate only recomputes the changed parties'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(3)
+            self.create_invoices(company, parties[:2], 2)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+            line, = PartyRecord.search([
+                    ('report', '=', report.id),
+                    ('party_name', '=', parties[0].name),
+                    ])
+            line.insurance = True
+            line.save()
+
+            self.create_invoices(company, parties[1:], 2)
+            Report.calculate([report])
+            lines = PartyRecord.search([('report', '=', report.id)],
+                order=[('party_name', 'ASC')])
+            self.assertEqual([(l.party_name, l.amount, l.insurance)
+                    for l in lines], [
+                    (parties[0].name, Decimal('6000.00'), True),
+                    (parties[1].name, Decimal('12000.00'), False),
+                    (parties[2].name, Decimal('6000.00'), False),
+                    ])
+            self.assertEqual(lines[0], line)
+
+            # The line of a fixed VAT number replaces the previous one
+            identifier, = parties[2].identifiers
+            identifier.code = 'ES00000004G'
+            identifier.save()
+            Report.calculate([report])
+            lines = PartyRecord.search([('report', '=', report.id)],
+                order=[('party_name', 'ASC')])
+            self.assertEqual([(l.party_vat, l.insurance) for l in lines], [
+                    ('00000001R', True),
+                    ('00000002W', False),
+                    ('00000004G', False),
+                    ])
+
+            # The settings of the report need a full calculation
+            Report.write([report], {'operation_limit': Decimal('7000')})
+            self.assertIsNone(Report(report.id).calculation_date)
+            Report.calculate([report])
+            self.assertEqual([l.party_name
+                    for l in Report(report.id).parties], [parties[1].name])
+
+    @with_transaction()
+    def test_property_records(self):
+        'Test the property records of rent invoices'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Property = pool.get('aeat.347.property')
+        Report = pool.get('aeat.347.report')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            property_, = Property.create([{
+                        'name': 'Premises',
+                        'situation': '1',
+                        'cadaster_number': '9872023VH5797S0001WX',
+                        'street': 'Main',
+                        'number_type': 'NUM',
+                        'number': '1',
+                        'number_qualifier': 'BIS',
+                        'municipality': 'Barcelona',
+                        'province_code': '08',
+                        'zip': '08001',
+                        }])
+            invoices = self.create_invoices(company, parties * 2, 4,
+                post=False)
+            Invoice.write(invoices[:1], {'aeat347_property': property_.id})
+            Invoice.post(invoices)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+
+            quarter = [
+                'first_quarter_property_amount',
+                'second_quarter_property_amount',
+                'third_quarter_property_amount',
+                'fourth_quarter_property_amount',
+                ][(datetime.date.today().month - 1) // 3]
+            lines = dict((l.party_name, l) for l in report.parties)
+            line = lines[parties[0].name]
+            self.assertEqual(line.amount, Decimal('12000.00'))
+            self.assertTrue(line.business_premises_rent)
+            self.assertEqual(line.property_amount, Decimal('6000.00'))
+            self.assertEqual(getattr(line, quarter), Decimal('6000.00'))
+            other = lines[parties[1].name]
+            self.assertFalse(other.business_premises_rent)
+            self.assertEqual(other.property_amount, Decimal('0.00'))
+
+            record, = report.properties
+            self.assertEqual(record.property, property_)
+            self.assertEqual((record.party_vat, record.party_name),
+                (line.party_vat, line.party_name))
+            self.assertEqual(record.amount, Decimal('6000.00'))
+            self.assertEqual(record.get_property_values(),
+                property_.get_property_values())
+
+    @with_transaction()
+    def test_invalid_parties(self):
+        'Test the party records with invalid VAT numbers'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 4)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+            self.assertEqual(report.invalid_parties, ())
+
+            line = report.parties[0]
+            line.party_vat = '00000000A'
+            line.save()
+            Report.validate_vat([report])
+            report = Report(report.id)
+            invalid, = report.invalid_parties
+            self.assertEqual(invalid, line)
+            self.assertEqual(invalid.vat_error_code, 'invalid_party_vat')
+            self.assertIn(line.party_name, invalid.vat_error)
+            with self.assertRaises(UserError):
+                report.check_invalid_parties()
+
+    @with_transaction()
+    def test_delete_party_records(self):
+        'Test reset the party records of reports'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+        Record = pool.get('aeat.347.record')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 4)
+            values = {
+                'company': company.id,
+                'fiscalyear': fiscalyear.id,
+                'fiscalyear_code': fiscalyear.start_date.year,
+                'company_vat': '00000000T',
+                }
+            report, other = Report.create([values, values])
+            Report.calculate([report])
+            other_line, = PartyRecord.create([{
+                        'report': other.id,
+                        'party_name': 'Other',
+                        }])
+            self.assertEqual(Record.search([
+                        ('party_record', '!=', None),
+                        ], count=True), 4)
+
+            Report.delete_party_records([report])
+            self.assertEqual(PartyRecord.search([]), [other_line])
+            self.assertEqual(Record.search([
+                        ('party_record', '!=', None),
+                        ], count=True), 0)
+
+            # The records are linked again by the next full calculation
+            Report.draft([report])
+            Report.calculate([report])
+            self.assertEqual(PartyRecord.search([
+                        ('report', '=', report.id),
+                        ], count=True), 2)
+            self.assertEqual(Record.search([
+                        ('party_record.report', '=', report.id),
+                        ], count=True), 4)
+
+            # The extended delete of party records is called
+            deleted = []
+            delete = PartyRecord.delete
+
+            def delete_logged(cls, records):
+                deleted.extend(records)
+                delete(records)
+
+            with patch.object(PartyRecord, 'delete',
+                    classmethod(delete_logged)):
+                Report.delete_party_records([report])
+            self.assertEqual(len(deleted), 2)
+            self.assertEqual(PartyRecord.search([]), [other_line])
+            self.assertEqual(Record.search([
+                        ('party_record', '!=', None),
+                        ], count=True), 0)
+
+    @with_transaction()
+    def test_purge_changes(self):
+        'Test calculate purges the changes read by all the reports'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        PartyChange = pool.get('aeat.347.party.change')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties[:1], 2)
+            values = {
+                'company': company.id,
+                'fiscalyear': fiscalyear.id,
+                'fiscalyear_code': fiscalyear.start_date.year,
+                'company_vat': '00000000T',
+                }
+            report, other = Report.create([values, values])
+            Report.calculate([report, other])
+
+            self.create_invoices(company, parties[1:], 2)
+            Report.calculate([other])
+            # The changes are kept until report reads them
+            self.assertTrue(PartyChange.search([]))
+            Report.calculate([report])
+            self.assertEqual(sorted((l.party_name, l.amount)
+                    for l in Report(report.id).parties), [
+                    (parties[0].name, Decimal('12000.00')),
+                    (parties[1].name, Decimal('12000.00')),
+                    ])
+
+            column = 'txid' if backend.name == 'postgresql' else 'id'
+            mark = min(r.calculation_mark
+                for r in Report.browse([report, other]))
+            self.assertFalse(PartyChange.search([(column, '<', mark)]))
+            if backend.name != 'postgresql':
+                # Changes on PostgreSQL are of the running transaction
+                self.assertFalse(PartyChange.search([]))
+
+    @with_transaction()
+    def test_derive(self):
+        'Test derive complementary declarations'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties[:1], 1)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+            line, = report.parties
+            line.insurance = True
+            line.save()
+            Report.write([report], {
+                    'state': 'done',
+                    'declaration_number': '3470000000001',
+                    })
+
+            copy, = Report.derive([report], 'S')
+            self.assertEqual(copy.type, 'S')
+            self.assertEqual(copy.previous_number, '3470000000001')
+            self.assertEqual(copy.state, 'calculated')
+            self.assertEqual([(l.party_name, l.amount, l.insurance)
+                    for l in copy.parties],
+                [(parties[0].name, Decimal('6000.00'), True)])
+
+            with self.assertRaises(UserError):
+                Report.derive([report], 'S', differences=True)
+
+            self.create_invoices(company, parties[1:], 1)
+            complementary, = Report.derive([report], 'C', differences=True)
+            self.assertEqual([(l.party_name, l.amount)
+                    for l in complementary.parties],
+                [(parties[1].name, Decimal('6000.00'))])
+            self.assertEqual(PartyRecord.search([
+                        ('report', '=', report.id),
+                        ], count=True), 1)
+
+    @with_transaction()
+    def test_compare(self):
+        'Test compare reports'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+        Comparison = pool.get('aeat.347.report.comparison')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(3)
+            self.create_invoices(company, parties[:2], 2)
+            values = {
+                'company': company.id,
+                'fiscalyear': fiscalyear.id,
+                'fiscalyear_code': fiscalyear.start_date.year,
+                'company_vat': '00000000T',
+                }
+            report, = Report.create([values])
+            Report.calculate([report])
+            for line in report.parties:
+                if line.party_name == parties[0].name:
+                    line.insurance = True
+                    line.save()
+                else:
+                    line.delete([line])
+
+            self.create_invoices(company, parties[2:], 1)
+            other, = Report.create([values])
+            Report.calculate([other])
+
+            comparison = Comparison.compare(other, report)
+            self.assertEqual(
+                (comparison.added_count, comparison.removed_count,
+                    comparison.changed_count), (2, 0, 1))
+            changed, = [l for l in comparison.lines if l.change == 'changed']
+            self.assertEqual(changed.party_name, parties[0].name)
+            self.assertEqual(changed.changed_fields, 'insurance')
+            self.assertEqual(changed.amount_difference, Decimal('0.00'))
+
+            # Duplicated and empty VAT numbers are matched one to one
+            report, other = Report.create([values, values])
+            lines = PartyRecord.create([{
+                        'report': r.id,
+                        'party_vat': vat,
+                        'party_name': name,
+                        'operation_key': 'B',
+                        } for r, vat, name in [
+                        (report, 'A', 'a'),
+                        (report, 'A', 'b'),
+                        (report, None, 'c'),
+                        (other, 'A', 'a'),
+                        (other, None, 'c'),
+                        (other, None, 'd'),
+                        ]])
+            ids = dict((l.id, (l.report.id, l.party_name)) for l in lines)
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*Comparison.match_lines(report, other))
+            self.assertEqual(
+                sorted((ids[l][1] if l else '', ids[o][1] if o else '')
+                    for l, o in cursor.fetchall()),
+                [('', 'd'), ('a', 'a'), ('b', ''), ('c', 'c')])
+
+    @with_transaction()
+    def test_export(self):
+        'Test export report to CSV'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        Attachment = pool.get('ir.attachment')
+        Export = pool.get('aeat.347.report.export', type='wizard')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 4)
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+
+            session_id, _, _ = Export.create()
+            export = Export(session_id)
+            export.start.format = 'csv'
+            with Transaction().set_context(active_ids=[report.id]):
+                export.transition_export()
+
+            parties_file, properties_file = Attachment.search([
+                    ('resource', '=', str(report)),
+                    ], order=[('name', 'ASC')])
+            rows = list(csv.reader(
+                    io.StringIO(parties_file.data.decode('utf-8'))))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual([r[-2:] for r in rows[1:]],
+                [['2', '2'], ['2', '2']])
+            rows = list(csv.reader(
+                    io.StringIO(properties_file.data.decode('utf-8'))))
+            self.assertEqual(len(rows), 1)
+
+        # The reports of the companies of other users are not exported
+        other = create_company(currency=company.currency)
+        with set_company(other):
+            with Transaction().set_context(active_ids=[report.id]):
+                with self.assertRaisesRegex(UserError, 'not allowed'):
+                    export.transition_export()
+
+    @with_transaction()
+    def test_reasign(self):
+        'Test reasign the operation key of posted invoices'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        Record = pool.get('aeat.347.record')
+        Reasign = pool.get('aeat.347.reasign.records', type='wizard')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(1)
+            invoice, = self.create_invoices(company, parties, 2)[:1]
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+            line, = report.parties
+            self.assertEqual(Record.search([], count=True), 2)
+
+            session_id, _, _ = Reasign.create()
+            reasign = Reasign(session_id)
+            reasign.start.aeat347_operation_key = 'A'
+            with Transaction().set_context(active_ids=[invoice.id]):
+                reasign.transition_reasign()
+
+            record, = Record.search([('invoice', '=', invoice.id)])
+            self.assertEqual(record.operation_key, 'A')
+            self.assertIsNone(record.party_record)
+
+            Report.calculate([report])
+            report = Report(report.id)
+            self.assertEqual(sorted((l.operation_key, l.amount)
+                    for l in report.parties), [
+                    ('A', Decimal('6000.00')),
+                    ('B', Decimal('6000.00')),
+                    ])
+            self.assertEqual(sorted((r.operation_key, r.party_record.id)
+                    for r in Record.search([])),
+                sorted((l.operation_key, l.id) for l in report.parties))
+
+    @with_transaction()
+    def test_get_page(self):
+        'Test keyset pages of records and party records'
+        pool = Pool()
+        Record = pool.get('aeat.347.record')
+        Report = pool.get('aeat.347.report')
+        PartyRecord = pool.get('aeat.347.report.party')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 5)
+
+            ids, after = [], None
+            while True:
+                page = Record.get_page(fiscalyear.id, after=after, limit=2)
+                self.assertLessEqual(len(page['id']), 2)
+                ids.extend(page['id'])
+                after = page['next']
+                if after is None:
+                    break
+            self.assertEqual(ids, sorted(r.id for r in Record.search([])))
+            page = Record.get_page(fiscalyear.id, quarter=5)
+            self.assertEqual(page['id'], [])
+
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        }])
+            Report.calculate([report])
+            line, = [l for l in report.parties
+                if l.party_name == parties[0].name]
+            self.assertEqual(line.record_count, 3)
+            self.assertEqual(line.invoice_count, 3)
+            self.assertEqual(line.monthly_amounts,
+                '%02d: 18000.00' % datetime.date.today().month)
+            page = PartyRecord.get_page(report.id, operation_keys=['B'])
+            self.assertEqual(sorted(page['party_name']),
+                sorted(p.name for p in parties))
+            self.assertIsNone(page['next'])
+
+        with Transaction().set_context(company=None):
+            page = Record.get_page(fiscalyear.id)
+            self.assertEqual(page['id'], [])
+
+        # The pages of the companies of other users are not readable
+        other = create_company(currency=company.currency)
+        with set_company(company):
+            with Transaction().set_context(company=other.id):
+                with self.assertRaises(UserError):
+                    Record.get_page(fiscalyear.id)
+                with self.assertRaises(UserError):
+                    PartyRecord.get_page(report.id)
+
+    @with_transaction()
+    def test_process(self):
+        'Test process several reports'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            parties = self.create_parties(2)
+            self.create_invoices(company, parties, 2)
+            reports = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        'group_by_vat': group_by_vat,
+                        } for group_by_vat in [False, True]])
+            Report.calculate(reports)
+            Report.process(reports)
+
+            numbers = []
+            for report in reports:
+                self.assertEqual(report.state, 'done')
+                lines = report.file_.decode('iso-8859-1').split('\r\n')
+                lines = [l for l in lines if l]
+                self.assertEqual(len(lines), 3)
+                self.assertTrue(lines[0].startswith('1347'))
+                self.assertIn(report.declaration_number, lines[0])
+                numbers.append(int(report.declaration_number))
+            self.assertEqual(numbers[1], numbers[0] + 1)
+
+    @with_transaction()
+    def test_consolidate(self):
+        'Test consolidate the reports of several companies'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        Record = pool.get('aeat.347.record')
+        User = pool.get('res.user')
+
+        companies = []
+        for code in ['ES00000000T', 'ES00000001R', 'ES00000002W']:
+            company, fiscalyear = self.setup_company()
+            company.party.identifiers = [{
+                    'type': 'eu_vat',
+                    'code': code,
+                    }]
+            company.party.save()
+            companies.append(company)
+        # The user has access to the first company and its child
+        companies[1].parent = companies[0]
+        companies[1].save()
+        User.write([User(Transaction().user)], {
+                'main_company': companies[0].id,
+                'company': companies[0].id,
+                })
+        parties = self.create_parties(3)
+        for company, number in zip(companies, [2, 3]):
+            with set_company(company):
+                self.create_invoices(company, parties[:number], number)
+
+        year = fiscalyear.start_date.year
+        with set_company(companies[0]):
+            with self.assertRaises(UserError):
+                Report.consolidate(companies, year)
+            reports = Report.consolidate(companies[:2], year)
+        self.assertEqual([(r.company, r.company_vat, r.state)
+                for r in reports], [
+                (companies[0], '00000000T', 'calculated'),
+                (companies[1], '00000001R', 'calculated'),
+                ])
+        self.assertEqual([r.party_count for r in reports], [2, 3])
+        for report in reports:
+            with set_company(report.company):
+                for line in report.parties:
+                    self.assertEqual(line.company, report.company)
+                    self.assertEqual(line.amount, Decimal('6000.00'))
+                    record, = Record.search([
+                            ('party_record', '=', line.id),
+                            ])
+                    self.assertEqual(record.company, report.company)
+
+        # The reports not done are calculated again
+        with set_company(companies[0]):
+            self.assertEqual(Report.consolidate(companies[:2], year), reports)
+
+    @with_transaction()
+    def test_calculate_queries(self):
+        'Test the queries to calculate a report do not grow with the parties'
+        pool = Pool()
+        Report = pool.get('aeat.347.report')
+        Record = pool.get('aeat.347.record')
+
+        company, fiscalyear = self.setup_company()
+        with set_company(company):
+            report, = Report.create([{
+                        'company': company.id,
+                        'fiscalyear': fiscalyear.id,
+                        'fiscalyear_code': fiscalyear.start_date.year,
+                        'company_vat': '00000000T',
+                        'contact_name': 'Contact',
+                        'contact_phone': '000000000',
+                        'representative_vat': '00000000T',
+                        }])
+            self.create_invoices(company, self.create_parties(2), 2)
+            Report.calculate([report])
+            for number in [2, 20]:
+                # A draft report is fully calculated and the calculated one
+                # incrementally
+                draft, = Report.copy([report], default={
+                        'state': 'draft',
+                        })
+                self.assertIsNone(draft.calculation_date)
+                for report_ in [draft, report]:
+                    # Start from a fresh instance so nothing is read from
+                    # cache
+                    report_ = Report(report_.id)
+                    with count_queries() as counter:
+                        Report.calculate([report_])
+                        Report.read([report_.id], ['party_count',
+                                'party_amount', 'cash_amount',
+                                'property_count', 'property_amount'])
+                    self.assertLessEqual(counter.count, 50)
+                    self.assertEqual(report_.party_count, number)
+                self.create_invoices(company,
+                    self.create_parties(18, start=3), 18)
+
+            records = Record.search([])
+            fields_names = ['fiscalyear.rec_name', 'month', 'party.rec_name',
+                'operation_key', 'amount', 'invoice.rec_name', 'party_name',
+                'party_vat', 'country_code', 'province_code']
+            for sub_records in [records[:2], records]:
+                with count_queries() as counter:
+                    Record.read([r.id for r in sub_records], fields_names)
+                self.assertLessEqual(counter.count, 8)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,133 @@
+# This file is part aeat_347 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+from contextlib import contextmanager
+
+from sql import Table
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.pool import Pool
+from trytond.tools import reduce_ids
+from trytond.transaction import Transaction
+
+__all__ = ['Excluded', 'batch_update', 'check_company', 'clear_loaded_cache',
+    'keyset_page']
+
+logger = logging.getLogger(__name__)
+
+
+class _Excluded(Table):
+    '''
+    The EXCLUDED table of ON CONFLICT DO UPDATE. It is quoted in lower case
+    as PostgreSQL folds the keyword and would not find "EXCLUDED".
+    '''
+
+    def __init__(self):
+        super(_Excluded, self).__init__('excluded')
+
+    @property
+    def alias(self):
+        return 'excluded'
+
+    @property
+    def has_alias(self):
+        return False
+
+
+Excluded = _Excluded()
+
+
+def batch_update(table, columns, values, where):
+    '''
+    Update the rows of table matching where in batches of ids.
+    Batches are walked in id order starting after the last id updated so
+    each one is a short indexed statement. They all run in the transaction
+    of the caller so a migration stays atomic.
+    Return the number of rows updated.
+    '''
+    cursor = Transaction().connection.cursor()
+    size = config.getint('aeat_347', 'batch_size', default=10000)
+
+    cursor.execute(*table.select(table.id, where=where, limit=1))
+    if not cursor.fetchone():
+        return 0
+
+    count, last_id = 0, 0
+    while True:
+        cursor.execute(*table.select(table.id,
+                where=where & (table.id > last_id),
+                order_by=[table.id.asc], limit=size))
+        ids = [i for i, in cursor.fetchall()]
+        if not ids:
+            break
+        cursor.execute(*table.update(columns=columns, values=values,
+                where=reduce_ids(table.id, ids)))
+        count += len(ids)
+        last_id = ids[-1]
+        logger.info('%s: %s rows updated', table._name, count)
+    return count
+
+
+def check_company(company_id):
+    '''
+    Raise an error if the company is not one of the companies of the user
+    of the transaction
+    '''
+    pool = Pool()
+    User = pool.get('res.user')
+    Company = pool.get('company.company')
+    transaction = Transaction()
+
+    if not transaction.user or company_id is None:
+        return
+    if company_id not in map(int, User(transaction.user).companies):
+        raise UserError(gettext('aeat_347.company_not_allowed',
+                company=Company(company_id).rec_name))
+
+
+@contextmanager
+def clear_loaded_cache():
+    '''
+    Remove from the transaction cache the records loaded inside the block on
+    exit. The records cached before are kept for the caller.
+    '''
+    transaction = Transaction()
+    cached = dict(((key, name), set(records))
+        for key, cache in transaction.cache.items()
+        for name, records in cache.items())
+    try:
+        yield
+    finally:
+        for key, cache in transaction.cache.items():
+            for name, records in cache.items():
+                kept = cached.get((key, name), set())
+                for id_ in [i for i in records if i not in kept]:
+                    del records[id_]
+
+
+def keyset_page(query, id_column, columns, where, after=None, limit=None):
+    '''
+    Return the rows of query matching where with id_column greater than
+    after, ordered by it, as a dictionary of value lists by column name.
+    Each page is a single query that starts from the index of id_column
+    instead of skipping the previous rows. columns is a list of name and
+    expression starting with id_column. The 'next' key is the value of after
+    for the following page, or None on the last one.
+    '''
+    cursor = Transaction().connection.cursor()
+    size = config.getint('aeat_347', 'page_size', default=1000)
+    limit = min(limit or size, size)
+
+    if after:
+        where &= id_column > after
+    names = [n for n, _ in columns]
+    cursor.execute(*query.select(*[c for _, c in columns],
+            where=where, order_by=[id_column.asc], limit=limit + 1))
+    rows = cursor.fetchall()
+    page = dict((n, [r[i] for r in rows[:limit]])
+        for i, n in enumerate(names))
+    page['next'] = rows[limit - 1][0] if len(rows) > limit else None
+    return page